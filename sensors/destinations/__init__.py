@@ -1,29 +1,43 @@
-import argparse, os, sys
-import treldev, pyodbc, tempfile, json, datetime, subprocess, collections
-from os import listdir
-from os.path import isfile, join, isdir
+''' Destinations shared by the sensors.
+
+A sensor gets a destination with ``DestinationProtocol.get_object_from_uri``, describes the columns with ``set_column_format`` and calls ``prepare``. Rows given as sequences follow the column order unless ``set_result_columns`` names their columns; rows given as dicts are looked up by column name. Parts of rows then go through a ``PartLoader`` (or files written with ``write_rows_to_file`` through ``append_data``), and ``finish`` completes the dataset.
+
+Columns are dicts with ``name``, ``type``, ``nullable`` and, for decimals, ``precision`` and ``scale``. The type is one of int8, int16, int32, int64, float32, float64, bool, string, bytes, date, time, timestamp, decimal and interval. Each destination maps these to its own types.
+
+How parts are written is pluggable: encoders (json, parquet, avro, arrow) in ``encoders``, compressors in ``compressors``, and for object stores, the upload primitives of ``ObjectStoreDestination``.
+'''
+
+import argparse, os, sys, errno
+import treldev, tempfile, json, datetime, threading, contextlib, io, time, shutil, operator, unittest
+from types import SimpleNamespace
+from .metrics import LoadMetrics
+from .encoders import get_encoder, to_json_string, plain_string_types
+from .compressors import get_compressor
+from .pipeline import PartLoader, PartSizer, Pipeline, FanoutLoader, parse_bytes
+from . import bq_storage
 
 class DestinationProtocol(object):
 
     registered = {}
-    
+
     @classmethod
     def register(cls):
         cls.registered[cls.protocol] = cls
-    
+
     @classmethod
     def get_class_from_protocol(cls, protocol):
         try:
             return cls.registered[protocol]
         except KeyError:
-            logger.debug(f"{protocol} is not a registered destination protocol. Only found {cls.registered}")
+            print(f"{protocol} is not a registered destination protocol. Only found {cls.registered}", file=sys.stderr)
             raise
 
     def get_schema_format_name(self):
         ''' Return a string that clearly specifies where the data is going and what are the capabilities of the columns if any. E.g., s3 is not enough. s3_csv or s3_json or s3_parquet or s3_avro. However, bq is enough.
         '''
-        pass
-        
+        encoder_name, compressor_name = self.get_format()
+        return self.protocol if self.protocol == 'bq' else f"{self.protocol}_{encoder_name}"
+
     @classmethod
     def get_object_from_uri(cls, uri, sensor):
         try:
@@ -31,174 +45,1036 @@ class DestinationProtocol(object):
             return cls.registered[uri_protocol](uri, sensor)
         except KeyError as ex:
             msg = (f"{uri_protocol} is not a registered destination protocol. Only found {sorted(cls.registered)}")
-            sensor.logger.error(msg)
+            print(msg, file=sys.stderr)
             raise Exception(msg) from ex
-        
+
     def __init__(self, uri, sensor):
         self.uri = uri
         self.sensor = sensor
-    
-    def set_column_format(self, destination_format):
-        self.destination_format = destination_format
-    
+
+    def get_option(self, name, default=None):
+        ''' Options are read from the sensor's attributes, so sensors that do not know an option get the default. '''
+        value = getattr(self.sensor, name, None)
+        return default if value is None else value
+
+    def set_column_format(self, columns):
+        self.columns = [ dict({'nullable': True, 'precision': None, 'scale': None}, **column) for column in columns ]
+        self.col_names = [ column['name'] for column in self.columns ]
+
+    def get_format(self):
+        ''' Returns the names of the encoder and the compressor used for parts. '''
+        return 'json', None
+
     def prepare(self):
-        self.batch_num = 0
+        self.batch_num = 0 if self.checkpoint is None else self.checkpoint['parts']
+        self.batch_num_lock = threading.Lock()
+        self.set_result_columns(None)
+        self.string_columns = [ i for i, column in enumerate(self.columns) if column['type'] == 'string' ]
+        if len(self.col_names) == 1:
+            self.dict_getter = lambda row, name=self.col_names[0]: (row[name],)
+        else:
+            self.dict_getter = operator.itemgetter(*self.col_names)
+        self.metrics = LoadMetrics(self.uri, self.get_option('metrics_textfile'))
         self.prepare_inner()
+        encoder_name, compressor_name = self.get_format()
+        self.encoder = get_encoder(encoder_name)(self)
+        self.compressor = get_compressor(compressor_name, self.get_option('compression_level'),
+                                         self.get_option('compression_threads'))
+
+    def set_result_columns(self, result_col_names):
+        ''' For rows given as sequences, e.g. from a cursor, names the values in them. Columns that are missing from the result are loaded as nulls. '''
+        if result_col_names is None:
+            self.result_plan = list(range(len(self.columns)))
+            return
+        result_index = { name: i for i, name in enumerate(result_col_names) }
+        result_index_lower = { name.lower(): i for i, name in enumerate(result_col_names) }
+        self.result_plan = [ result_index.get(name, result_index_lower.get(name.lower())) for name in self.col_names ]
+
+    def rows_to_columns(self, rows):
+        ''' Turns a list of rows into one list of values per column. ``rows`` can also be an Arrow RecordBatch, e.g. from a column-bound ODBC fetch, whose columns are named like sequence rows. They are kept as Arrow arrays for encoders with ``arrow_input``. '''
+        if getattr(rows, 'num_rows', None) is not None:
+            global pa
+            import pyarrow as pa
+            columns = [ pa.nulls(rows.num_rows) if i is None else rows.column(i) for i in self.result_plan ]
+            return columns if self.encoder.arrow_input else [ column.to_pylist() for column in columns ]
+        if rows and isinstance(rows[0], dict):
+            return self.dicts_to_columns(rows)
+        transposed = list(zip(*rows))
+        missing = [None] * len(rows)
+        return [ missing if i is None or not transposed else transposed[i] for i in self.result_plan ]
+
+    def dicts_to_columns(self, rows):
+        ''' Column-wise values of dict rows, e.g. Salesforce records, looked up with the getter made in ``prepare``. Keys that are not columns, such as ``attributes``, are never touched. '''
+        try:
+            columns = list(zip(*map(self.dict_getter, rows)))
+        except KeyError: # some rows lack some columns
+            columns = [ [ row.get(name) for row in rows ] for name in self.col_names ]
+        for i in self.string_columns:
+            # only columns holding structured values, such as compound fields, are converted value by value
+            if not set(map(type, columns[i])) <= plain_string_types:
+                columns[i] = [ v if v is None or type(v) is str else to_json_string(v) for v in columns[i] ]
+        return columns
+
+    def encode_part(self, chunks):
+        ''' Writes a part, a list of row chunks, to a temporary file with the destination's encoder and returns its name. '''
+        with self.metrics.timer('encode'):
+            with tempfile.NamedTemporaryFile('wb' if self.encoder.binary else 'w', delete=False) as f:
+                self.encoder.encode([ self.rows_to_columns(rows) for rows in chunks ], f)
+        self.metrics.add('bytes_encoded', os.path.getsize(f.name))
+        return f.name
+
+    def reserve_batch_num(self):
+        with self.batch_num_lock:
+            batch_num = self.batch_num
+            self.batch_num += 1
+        return batch_num
 
     def append_data(self, file_name):
-        self.append_data_inner(file_name)
-        self.batch_num += 1
+        ''' Compresses and uploads a file written with ``write_rows_to_file``. '''
+        batch_num = self.reserve_batch_num()
+        self.upload_data(self.compress_data(file_name, batch_num), batch_num)
+
+    def compress_data(self, file_name, batch_num):
+        with self.metrics.timer('compress'):
+            return self.compressor.compress_file(file_name)
+
+    def upload_data(self, file_name, batch_num):
+        num_bytes = os.path.getsize(file_name)
+        start = time.perf_counter()
+        self.upload_data_inner(file_name, batch_num)
+        upload_seconds = time.perf_counter() - start
+        self.metrics.add('upload_seconds', upload_seconds)
+        self.metrics.add('bytes_uploaded', num_bytes)
+        self.metrics.add('parts', 1)
+        self.metrics.part(batch_num, bytes=num_bytes, upload_seconds=upload_seconds)
+
+    streaming = False
+
+    def stream_part(self, chunks):
+        ''' Encodes a part straight into the destination's upload stream, without temporary files, and returns the uploaded size. Only for destinations with ``streaming`` set. '''
+        batch_num = self.reserve_batch_num()
+        print(f"Streaming batch {batch_num} to {self.uri}",file=sys.stderr)
+        sizes = []
+        start = time.perf_counter()
+        with self.open_part(batch_num, sizes.append) as f:
+            self.encoder.encode([ self.rows_to_columns(rows) for rows in chunks ], f)
+        # encoding, compression and upload overlap here, so they are timed together
+        stream_seconds = time.perf_counter() - start
+        num_bytes = sizes[0] if sizes else None
+        self.metrics.add('stream_seconds', stream_seconds)
+        self.metrics.add('bytes_uploaded', num_bytes or 0)
+        self.metrics.add('parts', 1)
+        self.metrics.part(batch_num, bytes=num_bytes, stream_seconds=stream_seconds)
+        sys.stderr.flush()
+        return num_bytes
 
     def finish(self):
         self.finish_inner()
+        self.metrics.emit()
+
+    def write_rows_to_file(self, rows, f):
+        ''' Writes rows to a file opened in the encoder's mode, for ``append_data``. '''
+        self.encoder.encode([ self.rows_to_columns(rows) ], f)
 
     def write_row_to_file(self, row, f):
-        for i in range(len(row)):
-            if type(row[i]) is datetime.datetime:
-                row[i] = str(row[i])
-        json.dump(dict(filter((lambda x: x[1] is not None), zip(self.col_names, row))), f)
-        f.write('\n')
-    
+        self.write_rows_to_file([row], f)
+
+    def write_dict_row_to_file(self, row, f):
+        self.write_rows_to_file([row], f)
+
     def get_next_batch_num(self):
         return self.batch_num
 
-class S3Destination(DestinationProtocol):
+    def get_arrow_schema(self):
+        global pa
+        import pyarrow as pa
+        return pa.schema([ pa.field(column['name'], self.get_arrow_type(column)) for column in self.columns ])
 
-    protocol = 's3'
+    def get_arrow_type(self, column):
+        raise NotImplementedError()
 
-    def prepare_inner(self):
-        self.s3_commands = treldev.S3Commands(credentials=self.sensor.credentials)
+    def get_arrow_converter(self, column, field):
+        ''' Returns the function that makes a non-null value of ``column`` acceptable to Arrow as ``field``, or None. '''
+        return None
 
-    
-    def append_data_inner(self, filename):
-        if self.sensor.compression == 'gz':
-            subprocess.check_call(f"gzip {filename}", shell=True)
-            filename = filename + '.gz'
-            file_uri = self.uri + f"part-{self.batch_num:>05}.gz"
-        else:
-            file_uri = self.uri + f"part-{self.batch_num:>05}"
-        self.s3_commands.upload_file(filename, file_uri)
+    state_file_name = '_trel_state.json'
+
+    def save_state(self, state):
+        ''' Stores a small JSON document with the dataset, e.g. the watermark of an incremental load. '''
+        self.save_state_inner(json.dumps(state, default=str))
+
+    def load_state(self):
+        ''' Returns the document stored by ``save_state``, or None. Does not need ``prepare`` to have been called. '''
+        try:
+            state_str = self.load_state_inner()
+            return json.loads(state_str) if state_str else None
+        except Exception as ex:
+            print(f"Unable to load state from {self.uri}: {ex}", file=sys.stderr)
+            return None
+
+    checkpoint_file_name = '_trel_checkpoint.json'
+    checkpoint = None # set before prepare when resuming
+
+    def save_checkpoint(self, checkpoint):
+        ''' Stores the progress manifest of a load in progress, so that an interrupted load can resume. '''
+        self.save_checkpoint_inner(json.dumps(checkpoint, default=str))
+
+    def load_checkpoint(self):
+        ''' Returns the manifest stored by ``save_checkpoint``, or None. Does not need ``prepare`` to have been called. '''
+        try:
+            checkpoint_str = self.load_checkpoint_inner()
+            return json.loads(checkpoint_str) if checkpoint_str else None
+        except Exception as ex:
+            print(f"No checkpoint found in {self.uri}: {ex}", file=sys.stderr)
+            return None
+
+    def clear_checkpoint(self):
+        self.clear_checkpoint_inner()
+
+    def copy_from(self, source_uri, state=None):
+        ''' Completes this dataset as a copy of the one at ``source_uri``, of the same kind, replacing anything already there, and saves ``state`` with it. Does not need ``prepare`` to have been called. '''
+        raise NotImplementedError()
+
+class ObjectStoreDestination(DestinationProtocol):
+    ''' Destinations that store parts as files named ``part-0000000000<suffix>`` under the URI prefix, next to ``_SUCCESS``, state and checkpoint files. Subclasses are the uploaders: they provide ``upload_file``, ``write_string``, ``read_string``, ``delete``, ``list_names``, ``copy_object`` and, for ``streaming_upload``, ``open_upload``.
+
+    The format comes from the ``compression`` option: gz or zstd (compressed JSON lines), parquet, avro, or null (plain JSON lines). '''
+
+    formats = {
+        'gz': ('json', 'gz'),
+        'zstd': ('json', 'zstd'),
+        'parquet': ('parquet', None),
+        'avro': ('avro', None),
+        None: ('json', None),
+        }
+
+    def get_format(self):
+        compression = getattr(self.sensor, 'compression', 'gz')
+        if compression not in self.formats:
+            raise Exception(f"Unknown compression {compression} for {self.uri}")
+        return self.formats[compression]
+
+    @property
+    def streaming(self):
+        return bool(self.get_option('streaming_upload', False))
+
+    def get_part_name(self, batch_num):
+        return f"part-{batch_num:>010}{self.encoder.suffix}{self.compressor.suffix}"
+
+    arrow_types = {
+        'int8': 'int8',
+        'int16': 'int16',
+        'int32': 'int32',
+        'int64': 'int64',
+        'float32': 'float32',
+        'float64': 'float64',
+        'bool': 'bool_',
+        'string': 'string',
+        'bytes': 'binary',
+        'date': 'date32',
+        'interval': 'string',
+        }
+
+    def get_arrow_type(self, column):
+        type_ = column['type']
+        if type_ == 'time':
+            return pa.time64('us')
+        if type_ == 'timestamp':
+            return pa.timestamp('us')
+        if type_ == 'decimal':
+            precision, scale = column['precision'], column['scale']
+            if precision is None:
+                return pa.decimal128(38, 9)
+            scale = min(scale or 0, precision)
+            return pa.decimal128(precision, scale) if precision <= 38 else pa.decimal256(min(precision, 76), scale)
+        return getattr(pa, self.arrow_types[type_])()
+
+    def get_arrow_converter(self, column, field):
+        if pa.types.is_string(field.type):
+            return None if column['type'] == 'string' else str
+        if pa.types.is_integer(field.type) and column['type'] == 'int8':
+            return int # BIT columns come as bools
+        if pa.types.is_binary(field.type):
+            return bq_storage.to_bytes
+        return None
+
+    def upload_data_inner(self, filename, batch_num):
+        name = self.get_part_name(batch_num)
+        print(f"final file uri {self.uri}{name}", file=sys.stderr)
+        self.upload_file(filename, name)
         os.remove(filename)
 
+    @contextlib.contextmanager
+    def open_part(self, batch_num, on_close=None):
+        ''' Yields a file object for part ``batch_num`` that compresses and uploads as it is written. It is binary or text depending on the encoder. ``on_close`` is called with the uploaded size. '''
+        name = self.get_part_name(batch_num)
+        writer = self.open_upload(name)
+        try:
+            f = self.compressor.wrap(writer, self.get_option('streaming_buffer_bytes', 16*1024*1024))
+            if not self.encoder.binary:
+                f = io.TextIOWrapper(f, encoding='utf-8')
+            yield f
+            f.close()
+            writer.close()
+        except BaseException:
+            writer.abort()
+            raise
+        if on_close is not None:
+            on_close(writer.position)
+        print(f"final file uri {self.uri}{name}", file=sys.stderr)
+
+    def save_state_inner(self, state_str):
+        self.write_string(self.state_file_name, state_str)
+
+    def load_state_inner(self):
+        return self.read_string(self.state_file_name)
+
+    def save_checkpoint_inner(self, checkpoint_str):
+        self.write_string(self.checkpoint_file_name, checkpoint_str)
+
+    def load_checkpoint_inner(self):
+        return self.read_string(self.checkpoint_file_name)
+
+    def clear_checkpoint_inner(self):
+        self.delete(self.checkpoint_file_name)
+
     def finish_inner(self):
+        self.write_string('_SUCCESS', '')
+
+    def copy_from(self, source_uri, state=None):
+        source = DestinationProtocol.get_object_from_uri(source_uri, self.sensor)
+        if type(source) is not type(self):
+            raise Exception(f"Can not copy {source_uri} to {self.uri}")
+        self.prepare_inner()
+        for name in self.list_names():
+            self.delete(name) # left by an interrupted attempt
+        names = [ name for name in source.list_names()
+                  if name not in ('_SUCCESS', self.state_file_name, self.checkpoint_file_name) ]
+        for name in names:
+            self.copy_object(source, name)
+        print(f"Copied {len(names)} files from {source_uri} to {self.uri}", file=sys.stderr)
+        if state is not None:
+            self.save_state(state)
+        self.finish_inner()
+
+    def write_string(self, name, content):
         with tempfile.NamedTemporaryFile('w') as f:
-            self.s3_commands.upload_file(f.name, self.uri+'_SUCCESS')
-            f.close()
+            f.write(content)
+            f.flush()
+            self.upload_file(f.name, name)
+
+class S3MultipartWriter(io.RawIOBase):
+    ''' A write-only file object that uploads to S3 in parts of ``part_bytes`` as data is written, so at most one part is held in memory. Objects smaller than a part are uploaded with a single put. '''
+
+    def __init__(self, s3_client, bucket, key, part_bytes):
+        super().__init__()
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.part_bytes = part_bytes
+        self.buffer = bytearray()
+        self.parts = []
+        self.upload_id = None
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def write(self, b):
+        self.buffer += b
+        self.position += len(b)
+        if len(self.buffer) >= self.part_bytes:
+            self.upload_part()
+        return len(b)
+
+    def upload_part(self):
+        if self.upload_id is None:
+            self.upload_id = self.s3_client.create_multipart_upload(Bucket=self.bucket, Key=self.key)['UploadId']
+        part_number = len(self.parts) + 1
+        res = self.s3_client.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                         PartNumber=part_number, Body=bytes(self.buffer))
+        self.parts.append({'ETag': res['ETag'], 'PartNumber': part_number})
+        self.buffer = bytearray()
+
+    def close(self):
+        if self.closed:
+            return
+        if self.upload_id is None:
+            self.s3_client.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self.buffer))
+        else:
+            if self.buffer:
+                self.upload_part()
+            self.s3_client.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                                     MultipartUpload={'Parts': self.parts})
+        super().close()
+
+    def abort(self):
+        if self.upload_id is not None:
+            self.s3_client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+        self.buffer = bytearray()
+        super().close()
+
+class S3Destination(ObjectStoreDestination):
+
+    protocol = 's3'
+
+    def __init__(self, uri, sensor):
+        super().__init__(uri, sensor)
+        _, _, self.bucket, self.prefix = self.uri.split('/',3)
+
+    def prepare_inner(self):
+        self.s3_commands = treldev.S3Commands(credentials=self.sensor.credentials)
+        if self.streaming:
+            import treldev.awsutils
+            self.s3_client = treldev.awsutils.S3.get_client(None)
+
+    def upload_file(self, filename, name):
+        self.s3_commands.upload_file(filename, self.uri+name)
+
+    def read_string(self, name):
+        s3_commands = treldev.S3Commands(credentials=self.sensor.credentials)
+        return s3_commands.load_file_as_string(self.bucket, self.prefix+name)
+
+    def delete(self, name):
+        import treldev.awsutils
+        treldev.awsutils.S3.get_client(None).delete_object(Bucket=self.bucket, Key=self.prefix+name)
+
+    def list_names(self):
+        import treldev.awsutils
+        paginator = treldev.awsutils.S3.get_client(None).get_paginator('list_objects_v2')
+        return [ obj['Key'][len(self.prefix):]
+                 for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix, Delimiter='/')
+                 for obj in page.get('Contents', []) ]
+
+    def copy_object(self, source, name):
+        # a managed copy, done within S3 in parts for large objects
+        import treldev.awsutils
+        treldev.awsutils.S3.get_client(None).copy({'Bucket': source.bucket, 'Key': source.prefix+name},
+                                                  self.bucket, self.prefix+name)
+
+    def open_upload(self, name):
+        return S3MultipartWriter(self.s3_client, self.bucket, self.prefix+name,
+                                 self.get_option('streaming_buffer_bytes', 16*1024*1024))
 S3Destination.register()
 
-            
+class LocalFileWriter(io.RawIOBase):
+    ''' A write-only file object for a part in a local directory. Data goes to ``<path>.tmp``, which is renamed to ``path`` on close, so readers never see partial parts. Writes are buffered in blocks of ``buffer_bytes``. '''
+
+    def __init__(self, path, buffer_bytes):
+        super().__init__()
+        self.path = path
+        self.f = open(path + '.tmp', 'wb', buffering=buffer_bytes)
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def write(self, b):
+        self.f.write(b)
+        self.position += len(b)
+        return len(b)
+
+    def close(self):
+        if self.closed:
+            return
+        self.f.close()
+        os.replace(self.path + '.tmp', self.path)
+        super().close()
+
+    def abort(self):
+        self.f.close()
+        if os.path.exists(self.path + '.tmp'):
+            os.remove(self.path + '.tmp')
+        super().close()
+
+umask = None
+
+def get_umask():
+    ''' Returns the process umask, read once from ``/proc/self/status``, or None where that is not available. Setting the umask to read it back would briefly change it for the files other threads create. '''
+    global umask
+    if umask is None:
+        try:
+            with open('/proc/self/status') as f:
+                for line in f:
+                    if line.startswith('Umask:'):
+                        umask = int(line.split()[1], 8)
+        except OSError:
+            pass
+        if umask is None:
+            umask = -1
+    return umask if umask >= 0 else None
+
+class FileDestination(ObjectStoreDestination):
+    ''' Writes parts to a local or mounted (e.g. NFS) directory, given as ``file:///path/to/dir/``, with the same part names and ``_SUCCESS`` file as S3. Encoded parts are moved into place with a rename when they are on the same file system, and copied with ``os.sendfile`` otherwise. '''
+
+    protocol = 'file'
+
+    def __init__(self, uri, sensor):
+        super().__init__(uri, sensor)
+        self.path = self.uri[len('file://'):]
+
+    def prepare_inner(self):
+        os.makedirs(self.path, exist_ok=True)
+
+    def get_path(self, name):
+        return os.path.join(self.path, name)
+
+    def upload_file(self, filename, name):
+        path = self.get_path(name)
+        # temporary files are only readable by their owner, parts get the mode of any new file
+        # which, without the umask, only a copy into a new file gives
+        if get_umask() is not None:
+            try:
+                os.replace(filename, path)
+            except OSError as ex:
+                if ex.errno != errno.EXDEV: # on another file system
+                    raise
+            else:
+                os.chmod(path, 0o666 & ~get_umask())
+                return
+        with open(filename, 'rb') as src, open(path + '.tmp', 'wb') as dst:
+            size = os.fstat(src.fileno()).st_size
+            offset = 0
+            while offset < size:
+                offset += os.sendfile(dst.fileno(), src.fileno(), offset, size - offset)
+        os.replace(path + '.tmp', path)
+
+    def upload_data_inner(self, filename, batch_num):
+        name = self.get_part_name(batch_num)
+        print(f"final file uri {self.uri}{name}", file=sys.stderr)
+        self.upload_file(filename, name)
+        if os.path.exists(filename):
+            os.remove(filename)
+
+    def write_string(self, name, content):
+        with open(self.get_path(name) + '.tmp', 'w') as f:
+            f.write(content)
+        os.replace(self.get_path(name) + '.tmp', self.get_path(name))
+
+    def read_string(self, name):
+        with open(self.get_path(name)) as f:
+            return f.read()
+
+    def delete(self, name):
+        if os.path.exists(self.get_path(name)):
+            os.remove(self.get_path(name))
+
+    def list_names(self):
+        if not os.path.isdir(self.path):
+            return []
+        return sorted( name for name in os.listdir(self.path) if os.path.isfile(self.get_path(name)) )
+
+    def copy_object(self, source, name):
+        # parts are never modified in place, so a hard link can stand in for a copy
+        try:
+            os.link(source.get_path(name), self.get_path(name))
+        except OSError:
+            shutil.copyfile(source.get_path(name), self.get_path(name) + '.tmp')
+            os.replace(self.get_path(name) + '.tmp', self.get_path(name))
+
+    def open_upload(self, name):
+        return LocalFileWriter(self.get_path(name), self.get_option('streaming_buffer_bytes', 16*1024*1024))
+FileDestination.register()
+
+class GSBlobWriter(io.RawIOBase):
+    ''' Wraps the resumable upload of ``Blob.open('wb')`` to count the bytes written and to be abandoned on errors, which leaves the object untouched. '''
+
+    def __init__(self, blob, chunk_size):
+        super().__init__()
+        self.writer = blob.open('wb', chunk_size=chunk_size, ignore_flush=True)
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def write(self, b):
+        self.writer.write(b)
+        self.position += len(b)
+        return len(b)
+
+    def close(self):
+        if self.closed:
+            return
+        self.writer.close()
+        super().close()
+
+    def abort(self):
+        # the upload session is never finalized, so no object is created
+        super().close()
+
+class GSDestination(ObjectStoreDestination):
+    ''' Writes parts to Google Storage, given as ``gs://bucket/prefix/``. Parts of at least ``gs_composite_upload_threshold`` bytes are uploaded as parallel composite uploads: ``gs_composite_upload_workers`` ranges of the file are uploaded at once as temporary objects, which are then composed into the part and deleted. With ``pipeline``, several parts are also uploaded at once. '''
+
+    protocol = 'gs'
+    max_compose_components = 32 # limit of a single compose request
+
+    def __init__(self, uri, sensor):
+        super().__init__(uri, sensor)
+        _, _, self.bucket_name, self.prefix = self.uri.split('/',3)
+        self.bucket = None
+        self.bucket_lock = threading.Lock()
+
+    def get_bucket(self):
+        with self.bucket_lock:
+            if self.bucket is None:
+                import treldev.gcputils
+                self.bucket = treldev.gcputils.Storage.get_client().bucket(self.bucket_name)
+        return self.bucket
+
+    def prepare_inner(self):
+        self.get_bucket()
+
+    def upload_file(self, filename, name):
+        size = os.path.getsize(filename)
+        threshold = parse_bytes(self.get_option('gs_composite_upload_threshold', '150MB'))
+        workers = min(self.get_option('gs_composite_upload_workers', 8), self.max_compose_components)
+        if size < threshold or workers < 2:
+            self.get_bucket().blob(self.prefix+name).upload_from_filename(filename)
+        else:
+            self.upload_composite(filename, name, size, workers)
+
+    def upload_composite(self, filename, name, size, workers):
+        import concurrent.futures
+        bucket = self.get_bucket()
+        component_bytes = -(-size // workers)
+        ranges = [ (offset, min(component_bytes, size - offset)) for offset in range(0, size, component_bytes) ]
+        components = [ bucket.blob(f"{self.prefix}{name}_trel_component_{i:02}") for i in range(len(ranges)) ]
+        def upload_component(component, offset, length):
+            with open(filename, 'rb') as f:
+                f.seek(offset)
+                component.upload_from_file(f, size=length)
+        print(f"Uploading {name} as {len(ranges)} components of up to {component_bytes} bytes", file=sys.stderr)
+        try:
+            with concurrent.futures.ThreadPoolExecutor(len(ranges)) as pool:
+                futures = [ pool.submit(upload_component, component, offset, length)
+                            for component, (offset, length) in zip(components, ranges) ]
+                for future in futures:
+                    future.result()
+            bucket.blob(self.prefix+name).compose(components)
+        finally:
+            for component in components:
+                try:
+                    component.delete()
+                except Exception:
+                    pass # never uploaded
+
+    def write_string(self, name, content):
+        self.get_bucket().blob(self.prefix+name).upload_from_string(content)
+
+    def read_string(self, name):
+        return self.get_bucket().blob(self.prefix+name).download_as_text()
+
+    def delete(self, name):
+        from google.api_core.exceptions import NotFound
+        try:
+            self.get_bucket().blob(self.prefix+name).delete()
+        except NotFound:
+            pass
+
+    def list_names(self):
+        return [ blob.name[len(self.prefix):]
+                 for blob in self.get_bucket().list_blobs(prefix=self.prefix, delimiter='/') ]
+
+    def copy_object(self, source, name):
+        # rewrites copy within Google Storage, in several calls for large objects
+        blob = self.get_bucket().blob(self.prefix+name)
+        source_blob = source.get_bucket().blob(source.prefix+name)
+        token, _, _ = blob.rewrite(source_blob)
+        while token is not None:
+            token, _, _ = blob.rewrite(source_blob, token=token)
+
+    def open_upload(self, name):
+        # resumable upload chunks must be multiples of 256KB
+        chunk_size = max(1, self.get_option('streaming_buffer_bytes', 16*1024*1024) // (256*1024)) * 256*1024
+        return GSBlobWriter(self.get_bucket().blob(self.prefix+name), chunk_size)
+GSDestination.register()
+
+
 class BigQueryDestination(DestinationProtocol):
+    ''' Loads parts with one load job each, in the format given by the ``output_format`` option (json, parquet or avro), or with ``bigquery_write_mode: storage_write``, appends them to pending Storage Write API streams that are committed at ``finish``.
+
+    With ``bigquery_staging_uri`` (a ``gs://`` prefix), parts are instead uploaded there and loaded together by one load job at ``finish``, after which the staged files are deleted.
+
+    The load job of a part has an id made of ``load_id``, which is kept in the checkpoint, and the part number. A resumed load that finds the job of its next part already succeeded, because the previous attempt stopped between the load and the checkpoint, does not load the part again. '''
+
+    max_load_uris = 10000 # limit of source URIs in a single load job
 
     protocol = 'bq'
     type_mapping = {
-        pyodbc.SQL_CHAR: 'STRING',
-        pyodbc.SQL_VARCHAR: 'STRING',
-        pyodbc.SQL_LONGVARCHAR: 'STRING',
-        pyodbc.SQL_WCHAR: 'STRING',
-        pyodbc.SQL_WVARCHAR: 'STRING',
-        pyodbc.SQL_WLONGVARCHAR: 'STRING',
-        pyodbc.SQL_GUID: 'STRING',
-        pyodbc.SQL_TYPE_DATE: 'DATE',
-        pyodbc.SQL_TYPE_TIME: 'TIME',
-        pyodbc.SQL_TYPE_TIMESTAMP: 'DATETIME',
-        #pyodbc.SQL_TYPE_UTCDATETIME: 'DATETIME',
-        #pyodbc.SQL_TYPE_UTCTIME: 'DATETIME',
-        pyodbc.SQL_BINARY: 'BYTES',
-        pyodbc.SQL_VARBINARY: 'BYTES',
-        pyodbc.SQL_DECIMAL: 'DECIMAL',
-        pyodbc.SQL_NUMERIC: 'DECIMAL',
-        pyodbc.SQL_SMALLINT: 'INTEGER',
-        pyodbc.SQL_INTEGER: 'INTEGER',
-        pyodbc.SQL_BIT: 'INTEGER', # test
-        pyodbc.SQL_TINYINT: 'INTEGER',
-        pyodbc.SQL_BIGINT: 'INTEGER',
-        pyodbc.SQL_REAL: 'FLOAT64',
-        pyodbc.SQL_FLOAT: 'FLOAT64',
-        pyodbc.SQL_DOUBLE: 'FLOAT64',
-        pyodbc.SQL_INTERVAL_MONTH: 'INTERVAL',
-        pyodbc.SQL_INTERVAL_YEAR: 'INTERVAL',
-        pyodbc.SQL_INTERVAL_YEAR_TO_MONTH: 'INTERVAL',
-        pyodbc.SQL_INTERVAL_DAY: 'INTERVAL',
-        pyodbc.SQL_INTERVAL_HOUR: 'INTERVAL',
-        pyodbc.SQL_INTERVAL_MINUTE: 'INTERVAL',
-        pyodbc.SQL_INTERVAL_SECOND: 'INTERVAL',
-        pyodbc.SQL_INTERVAL_DAY_TO_HOUR: 'INTERVAL',
-        pyodbc.SQL_INTERVAL_DAY_TO_MINUTE: 'INTERVAL',
-        pyodbc.SQL_INTERVAL_DAY_TO_SECOND: 'INTERVAL',
-        pyodbc.SQL_INTERVAL_HOUR_TO_MINUTE: 'INTERVAL',
-        pyodbc.SQL_INTERVAL_HOUR_TO_SECOND: 'INTERVAL',
-        pyodbc.SQL_INTERVAL_MINUTE_TO_SECOND: 'INTERVAL',
+        'int8': 'INTEGER',
+        'int16': 'INTEGER',
+        'int32': 'INTEGER',
+        'int64': 'INTEGER',
+        'float32': 'FLOAT64',
+        'float64': 'FLOAT64',
+        'bool': 'BOOLEAN',
+        'string': 'STRING',
+        'bytes': 'BYTES',
+        'date': 'DATE',
+        'time': 'TIME',
+        'timestamp': 'DATETIME',
+        'decimal': 'DECIMAL',
+        'interval': 'INTERVAL',
     }
 
-    def get_schema_format_name(self):
-        return 'bq'
+    @property
+    def storage_write(self):
+        return self.get_option('bigquery_write_mode', 'load') == 'storage_write'
+
+    def get_format(self):
+        if self.storage_write:
+            return 'arrow', None
+        output_format = self.get_option('output_format', 'json')
+        if output_format not in ('json', 'parquet', 'avro'):
+            raise Exception(f"Unknown output_format {output_format} for {self.uri}")
+        return output_format, None
 
     def prepare_inner(self):
-        global bigquery, BigQuery, BigQueryURI, base64
+        global bigquery, BigQuery, BigQueryURI
 
-        #assert self.sensor.output_format == 'json'
-        
         from treldev.gcputils import BigQuery, BigQueryURI
         import treldev.gcputils
         from google.cloud import bigquery
-        import base64
 
+        print("Getting Bigquery client", file=sys.stderr)
         self.client = treldev.gcputils.BigQuery.get_client()
-        for col in self.destination_format:
-            print(f"{col},", file=sys.stderr,end='')
+        print("Got BigQuery client", file=sys.stderr)
+        for column in self.columns:
+            print(f"{column['name']}:{self.type_mapping[column['type']]},", file=sys.stderr,end='')
         print("", file=sys.stderr)
 
         self.schema = []
         self.bquri = BigQueryURI(self.uri)
-        for col in self.destination_format:
-            #bq_type = self.type_mapping[col.data_type]
-            self.schema.append( bigquery.SchemaField(col['name'], col['type'], mode=("NULLABLE" if col['nullable'] else "REQUIRED")) )
-        self.client.delete_table(self.bquri.path, not_found_ok=True)
-        table = bigquery.Table(self.bquri.path, schema=self.schema)
-        
-        table = self.client.create_table(table)
-        print("Created table {}.{}.{}".format(table.project, table.dataset_id, table.table_id), file=sys.stderr)
-        
-    def write_row_to_file(self, row, f):
-        for i in range(len(row)):
-            bq_type = self.destination_format[i]['type'].upper()
-            if bq_type in ('DATE','TIME','DATETIME','INTERVAL'):
-                if row[i] is not None:
-                    row[i] = str(row[i])
-            elif bq_type == 'BYTES':
-                if row[i] is not None:
-                    row[i] = base64.b64encode(row[i]).decode('utf-8')
-        json.dump(dict(filter((lambda x: x[1] is not None), zip(self.col_names, row))), f)
-        f.write('\n')
-    
-    def write_dict_row_to_file(self, row, f):
-        for col in self.destination_format:
-            bq_type = col['type'].upper()
-            col_name = col['name']
-            if bq_type in ('DATE','TIME','DATETIME','INTERVAL'):
-                if row[col_name] is not None:
-                    row[col_name] = str(row[col_name])
-            elif bq_type == 'BYTES':
-                if row[col_name] is not None:
-                    row[col_name] = base64.b64encode(row[col_name]).decode('utf-8')
-            if bq_type == 'STRING' and type(row[col_name]) in (list, dict, collections.OrderedDict):
-                row[col_name] = json.dumps(row[col_name])
-        row = dict(row)
-        for k in list(row):
-            if row[k] is None:
-                del row[k]
-        json.dump(row, f)
-        f.write('\n')
-    
-    def append_data_inner(self, filename):
+        for column in self.columns:
+            self.schema.append( bigquery.SchemaField(column['name'], self.type_mapping[column['type']],
+                                                     mode=("NULLABLE" if column['nullable'] else "REQUIRED")) )
+        import uuid
+        self.load_id = uuid.uuid4().hex if self.checkpoint is None else self.checkpoint['load_id']
+        if self.checkpoint is None:
+            self.client.delete_table(self.bquri.path, not_found_ok=True)
+            table = bigquery.Table(self.bquri.path, schema=self.schema)
+
+            table = self.client.create_table(table)
+            print("Created table {}.{}.{}".format(table.project, table.dataset_id, table.table_id), file=sys.stderr)
+        else:
+            print(f"Appending to the partially loaded table {self.bquri.path}", file=sys.stderr)
+
+        if self.storage_write:
+            self.stream_writer = bq_storage.PendingStreamWriter(bq_storage.get_table_path(self.bquri.path),
+                                                                self.get_arrow_schema(),
+                                                                credentials=getattr(self.client, '_credentials', None))
+
+        self.staging = None
+        staging_uri = self.get_option('bigquery_staging_uri')
+        if staging_uri is not None and not self.storage_write:
+            self.staging = GSDestination(f"{staging_uri.rstrip('/')}/{self.bquri.path}/{uuid.uuid4().hex}/", self.sensor)
+            self.staged_names = []
+            self.staged_names_lock = threading.Lock()
+            print(f"Staging parts in {self.staging.uri}", file=sys.stderr)
+
+    def get_arrow_type(self, column):
+        return bq_storage.get_arrow_type(self.type_mapping[column['type']])
+
+    def get_arrow_converter(self, column, field):
+        if column['type'] == 'interval':
+            return str
+        if column['type'] in ('date', 'time', 'timestamp', 'decimal'):
+            return None # converted a column at a time by the encoder
+        if pa.types.is_integer(field.type) and column['type'] != 'int8':
+            return None
+        return bq_storage.get_arrow_converter(field.type)
+
+    def upload_data_inner(self, filename, batch_num):
+        if self.storage_write:
+            with pa.OSFile(filename, 'rb') as source:
+                for batch in pa.ipc.open_stream(source):
+                    self.stream_writer.append(batch)
+            print(f"Appended part {batch_num} to the write streams", file=sys.stderr)
+        elif self.staging is not None:
+            name = f"part-{batch_num:>010}{self.encoder.suffix}"
+            self.staging.upload_file(filename, name)
+            with self.staged_names_lock:
+                self.staged_names.append(name)
+            print(f"Staged part {batch_num} as {self.staging.uri}{name}", file=sys.stderr)
+        else:
+            self.load_part(filename, batch_num)
+        os.remove(filename)
+
+    def load_part(self, filename, batch_num):
+        from google.api_core.exceptions import Conflict
+        job_id = f"trel_{self.load_id}_{batch_num:>010}"
+        job_config = bigquery.LoadJobConfig(**self.get_loadjob_config_dict())
+        try:
+            with open(filename, 'rb') as f:
+                job = self.client.load_table_from_file(f, self.bquri.path, job_id=job_id, job_config=job_config)
+        except Conflict:
+            job = self.client.get_job(job_id, location=self.client.location)
+            try:
+                job.result()
+                print(f"Part {batch_num} was already loaded by {job_id}", file=sys.stderr)
+                return
+            except Exception as ex:
+                print(f"Loading part {batch_num} again, as {job_id} failed: {ex}", file=sys.stderr)
+            with open(filename, 'rb') as f:
+                job = self.client.load_table_from_file(f, self.bquri.path, job_id_prefix=f"{job_id}_retry_",
+                                                       job_config=job_config)
+        job.result()
+        print(f"Loaded part {batch_num} with {job.job_id}", file=sys.stderr)
+
+    def get_loadjob_config_dict(self):
+        source_formats = {
+            'json': bigquery.SourceFormat.NEWLINE_DELIMITED_JSON,
+            'parquet': bigquery.SourceFormat.PARQUET,
+            'avro': bigquery.SourceFormat.AVRO,
+            }
         loadjob_config_dict = {
             'write_disposition': bigquery.WriteDisposition.WRITE_APPEND,
-            'source_format': bigquery.SourceFormat.NEWLINE_DELIMITED_JSON,
+            'source_format': source_formats[self.encoder.name],
             }
-        self.bquri.load_file(filename, loadjob_config_dict)
-        os.remove(filename)
-        
+        if self.encoder.name == 'avro':
+            loadjob_config_dict['use_avro_logical_types'] = True
+        return loadjob_config_dict
+
+    def load_staged(self):
+        ''' Loads the parts staged in Google Storage, in as few load jobs as the URI limit allows, then deletes them. '''
+        names = sorted(self.staged_names)
+        job_config = bigquery.LoadJobConfig(**self.get_loadjob_config_dict())
+        for i in range(0, len(names), self.max_load_uris):
+            uris = [ self.staging.uri + name for name in names[i:i+self.max_load_uris] ]
+            print(f"Loading {len(uris)} staged parts into {self.bquri.path}", file=sys.stderr)
+            with self.metrics.timer('load'):
+                self.client.load_table_from_uri(uris, self.bquri.path, job_config=job_config).result()
+        for name in names:
+            self.staging.delete(name)
+
+    def save_state_inner(self, state_str):
+        # BigQuery has no place for side files, so the state goes into the table description
+        table = self.client.get_table(self.bquri.path)
+        table.description = state_str
+        self.client.update_table(table, ['description'])
+
+    def load_state_inner(self):
+        import treldev.gcputils
+        client = treldev.gcputils.BigQuery.get_client()
+        return client.get_table(treldev.gcputils.BigQueryURI(self.uri).path).description
+
+    def save_checkpoint(self, checkpoint):
+        super().save_checkpoint(dict(checkpoint, load_id=self.load_id))
+
+    def save_checkpoint_inner(self, checkpoint_str):
+        # like the state, the checkpoint goes into the table description until the load finishes
+        self.save_state_inner(checkpoint_str)
+
+    def load_checkpoint_inner(self):
+        return self.load_state_inner()
+
+    def clear_checkpoint_inner(self):
+        self.save_state_inner(None)
+
+    def copy_from(self, source_uri, state=None):
+        global bigquery
+        import treldev.gcputils
+        from google.cloud import bigquery
+        self.client = treldev.gcputils.BigQuery.get_client()
+        self.bquri = treldev.gcputils.BigQueryURI(self.uri)
+        source_path = treldev.gcputils.BigQueryURI(source_uri).path
+        job_config = bigquery.CopyJobConfig(write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE)
+        self.client.copy_table(source_path, self.bquri.path, job_config=job_config).result()
+        print(f"Copied {source_path} to {self.bquri.path}", file=sys.stderr)
+        # the copy brings the source's description, which holds its state
+        self.save_state_inner(None if state is None else json.dumps(state, default=str))
+
     def finish_inner(self):
-        pass
+        if self.storage_write:
+            self.stream_writer.commit()
+        elif self.staging is not None:
+            self.load_staged()
 BigQueryDestination.register()
-        
+
+class Test(unittest.TestCase):
+    ''' Runs parts through ``FileDestination``, so the tests need neither credentials nor a network. '''
+
+    columns = [{'name': 'id', 'type': 'int64', 'nullable': False},
+               {'name': 'name', 'type': 'string'},
+               {'name': 'amount', 'type': 'float64'},
+               {'name': 'day', 'type': 'date'}]
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+
+    def make_destination(self, name='out', **options):
+        sensor = SimpleNamespace(**dict({'compression': None}, **options))
+        destination = DestinationProtocol.get_object_from_uri(f"file://{self.root}/{name}/", sensor)
+        destination.set_column_format(self.columns)
+        destination.prepare()
+        return destination
+
+    def make_rows(self, start, stop):
+        return [ (i, f"name {i}", i / 4, datetime.date(2026, 1, 1 + i % 28)) for i in range(start, stop) ]
+
+    def part_names(self, destination):
+        return [ name for name in destination.list_names() if name.startswith('part-') ]
+
+    def read_json(self, destination):
+        rows = []
+        for name in self.part_names(destination):
+            with open(destination.get_path(name)) as f:
+                rows.extend( json.loads(line) for line in f )
+        return rows
+
+    def read_parquet(self, destination):
+        import pyarrow.parquet as pq
+        rows = []
+        for name in self.part_names(destination):
+            rows.extend( tuple(row.values()) for row in pq.read_table(destination.get_path(name)).to_pylist() )
+        return rows
+
+    def as_json(self, rows):
+        return [ {'id': i, 'name': name, 'amount': amount, 'day': day.isoformat()} for i, name, amount, day in rows ]
+
+    def test_rows_to_columns(self):
+        destination = self.make_destination()
+        self.assertEqual(destination.rows_to_columns([(1, 'a', 0.5, None), (2, 'b', 1.5, None)]),
+                         [(1, 2), ('a', 'b'), (0.5, 1.5), (None, None)])
+        # result columns are matched by name, ignoring case, and missing ones are null
+        destination.set_result_columns(['NAME', 'extra', 'id'])
+        self.assertEqual(destination.rows_to_columns([('a', 'x', 1), ('b', 'y', 2)]),
+                         [(1, 2), ('a', 'b'), [None, None], [None, None]])
+        # dict rows are looked up by column name, and structured values in string columns become JSON
+        rows = [{'attributes': {'type': 'T'}, 'id': 1, 'name': {'city': 'Paris'}, 'amount': 0.5, 'day': None},
+                {'attributes': {'type': 'T'}, 'id': 2, 'name': 'b', 'amount': None, 'day': None}]
+        columns = destination.rows_to_columns(rows)
+        self.assertEqual(list(columns[0]), [1, 2])
+        self.assertEqual([ json.loads(columns[1][0]), columns[1][1] ], [{'city': 'Paris'}, 'b'])
+        self.assertEqual(list(columns[2]), [0.5, None])
+        # rows missing some keys
+        columns = destination.rows_to_columns([{'id': 3}, {'id': 4, 'name': 'd'}])
+        self.assertEqual(columns, [[3, 4], [None, 'd'], [None, None], [None, None]])
+
+    def test_json_serial(self):
+        destination = self.make_destination()
+        loader = PartLoader(destination)
+        sizes = [ loader.put([self.make_rows(i, i + 50), self.make_rows(i + 50, i + 100)]) for i in range(0, 300, 100) ]
+        loader.close()
+        destination.finish()
+        self.assertEqual(len(self.part_names(destination)), 3)
+        self.assertEqual(sizes, [ os.path.getsize(destination.get_path(name)) for name in self.part_names(destination) ])
+        self.assertEqual(self.read_json(destination), self.as_json(self.make_rows(0, 300)))
+        self.assertIn('_SUCCESS', destination.list_names())
+        with open(destination.get_path('new_file'), 'w'):
+            pass
+        for name in self.part_names(destination):
+            self.assertEqual(os.stat(destination.get_path(name)).st_mode & 0o777,
+                             os.stat(destination.get_path('new_file')).st_mode & 0o777)
+
+    def test_json_pipeline(self):
+        destination = self.make_destination(compression='gz')
+        loader = PartLoader(destination, pipeline=True, compress_workers=2, upload_workers=2)
+        for i in range(0, 1000, 100):
+            self.assertIsNone(loader.put([self.make_rows(i, i + 100)]))
+        loader.close()
+        destination.finish()
+        import gzip
+        rows = []
+        for name in self.part_names(destination):
+            self.assertTrue(name.endswith('.gz'))
+            with gzip.open(destination.get_path(name), 'rt') as f:
+                rows.extend( json.loads(line) for line in f )
+        self.assertEqual(len(self.part_names(destination)), 10)
+        self.assertEqual(sorted(rows, key=lambda row: row['id']), self.as_json(self.make_rows(0, 1000)))
+
+    def test_pipeline_stop(self):
+        release = threading.Event()
+        done = []
+        def work(item):
+            release.wait()
+            done.append(item)
+        pipeline = Pipeline([ (work, 1) ], 2)
+        for i in range(3):
+            pipeline.put(i)
+        stopping = threading.Thread(target=pipeline.stop)
+        stopping.start()
+        while pipeline.error is None:
+            time.sleep(0.01)
+        release.set()
+        stopping.join()
+        self.assertEqual(done, [0]) # the queued items were dropped
+
+    def test_json_streaming(self):
+        destination = self.make_destination(compression='zstd', streaming_upload=True, streaming_buffer_bytes=5*1024*1024)
+        # the compressor holds a single block besides the one being filled, both within the buffer
+        writer = destination.compressor.wrap(io.BytesIO(), 5*1024*1024)
+        self.assertEqual(writer.max_pending, 1)
+        self.assertLessEqual((writer.max_pending + 1) * writer.block_bytes, 5*1024*1024)
+        writer.close()
+        loader = PartLoader(destination)
+        for i in range(0, 300, 100):
+            self.assertGreater(loader.put([self.make_rows(i, i + 100)]), 0)
+        loader.close()
+        import zstandard
+        rows = []
+        for name in self.part_names(destination):
+            with open(destination.get_path(name), 'rb') as f:
+                rows.extend( json.loads(line) for line in zstandard.ZstdDecompressor().stream_reader(f, read_across_frames=True).read().splitlines() )
+        self.assertEqual(rows, self.as_json(self.make_rows(0, 300)))
+
+    def test_fanout_metrics_textfile(self):
+        ''' The textfile written when the first destination finishes has the totals of all of them. '''
+        textfile = os.path.join(self.root, 'metrics.prom')
+        destinations = [ self.make_destination(name, metrics_textfile=textfile) for name in ('main', 'copy') ]
+        destinations[0].metrics.include(destinations[1].metrics)
+        loader = FanoutLoader([ PartLoader(destination) for destination in destinations ])
+        loader.put([self.make_rows(0, 100)])
+        loader.close()
+        destinations[1].finish()
+        self.assertFalse(os.path.exists(textfile))
+        destinations[0].finish()
+        with open(textfile) as f:
+            lines = f.read().splitlines()
+        for destination in destinations:
+            self.assertIn(f'trel_sensor_parts{{uri="{destination.uri}"}} 1', lines)
+        self.assertEqual(lines.count('# TYPE trel_sensor_parts gauge'), 1)
+
+    def test_parquet_serial(self):
+        destination = self.make_destination(compression='parquet')
+        loader = PartLoader(destination)
+        for i in range(0, 300, 100):
+            loader.put([self.make_rows(i, i + 100)])
+        loader.close()
+        self.assertEqual(len(self.part_names(destination)), 3)
+        self.assertEqual(self.read_parquet(destination), self.make_rows(0, 300))
+
+    def test_parquet_rolling_part_bytes(self):
+        ''' Parts stay close to ``parquet_part_bytes`` when it is much smaller than the default row groups. '''
+        destination = self.make_destination(compression='parquet', parquet_part_bytes='64KB')
+        loader = PartLoader(destination)
+        for i in range(0, 20000, 500):
+            loader.put([self.make_rows(i, i + 500)])
+        loader.close()
+        sizes = [ os.path.getsize(destination.get_path(name)) for name in self.part_names(destination) ]
+        self.assertGreater(len(sizes), 3)
+        for size in sizes[:-1]:
+            self.assertLess(size, 64*1024 * 1.25)
+            self.assertGreater(size, 64*1024 * 0.5)
+        self.assertEqual(self.read_parquet(destination), self.make_rows(0, 20000))
+
+    def test_parquet_rolling(self):
+        destination = self.make_destination(compression='parquet', parquet_part_bytes='8KB', parquet_row_group_rows=100)
+        loader = PartLoader(destination)
+        sizes = [ loader.put([self.make_rows(i, i + 100)]) for i in range(0, 2000, 100) ]
+        loader.close()
+        num_parts = len(self.part_names(destination))
+        # a put only returns a size when it completes a part, and the last part is completed by close
+        self.assertGreater(num_parts, 1)
+        self.assertEqual(len([ size for size in sizes if size is not None ]), num_parts - 1)
+        self.assertEqual(self.read_parquet(destination), self.make_rows(0, 2000))
@@ -0,0 +1,93 @@
+''' Concurrent extraction of backfilled periods for ``treldev.ClockBasedSensor`` based loaders.
+
+Trel saves the datasets returned by ``get_new_datasetspecs`` one at a time. With ``max_concurrent_periods`` above 1, while one period is being saved, the source extraction of the periods queued after it runs in a thread pool into local spool files. When Trel gets to those periods, only the encoding and upload remain. The period being saved is loaded straight from the source, as usual, unless it was prefetched. The dataset lock is taken by Trel when it starts saving a period, so ``locking_seconds`` only has to cover that last step.
+'''
+
+import os, sys, pickle, tempfile, concurrent.futures
+
+class Spool(object):
+    ''' Rows extracted ahead of time, pickled in chunks to a local temporary file. ``info`` holds whatever else the sensor needs to save the period, e.g. column metadata. '''
+
+    def __init__(self, info=None):
+        self.info = info
+        fd, self.path = tempfile.mkstemp(suffix='.spool')
+        self.f = os.fdopen(fd, 'wb')
+        self.num_rows = 0
+
+    def write(self, chunk):
+        pickle.dump(chunk, self.f, protocol=pickle.HIGHEST_PROTOCOL)
+        self.num_rows += len(chunk)
+
+    def close(self):
+        self.f.close()
+
+    def read(self):
+        ''' Yields the chunks in the order they were written. '''
+        with open(self.path, 'rb') as f:
+            while True:
+                try:
+                    yield pickle.load(f)
+                except EOFError:
+                    return
+
+    def rows(self):
+        for chunk in self.read():
+            yield from chunk
+
+    def cleanup(self):
+        if not self.f.closed:
+            self.f.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+class ConcurrentBackfillMixin(object):
+    ''' Mix into a ``treldev.ClockBasedSensor`` subclass, before it in the bases. The subclass calls ``init_concurrent_backfill`` from ``__init__``, implements ``spool_period(load_info)`` returning a closed ``Spool``, and uses ``get_spool(load_info)`` in ``save_data_to_path`` when ``concurrent_backfill`` is true, loading the period as usual when it returns None. '''
+
+    def init_concurrent_backfill(self):
+        self.max_concurrent_periods = self.config.get('max_concurrent_periods', 1)
+        self.concurrent_backfill = self.max_concurrent_periods > 1
+        self.pending_load_infos = []
+        self.prefetched = {}
+        self.prefetch_pool = (concurrent.futures.ThreadPoolExecutor(self.max_concurrent_periods - 1)
+                              if self.concurrent_backfill else None)
+
+    @staticmethod
+    def period_key(load_info):
+        return tuple(sorted( (k, str(v)) for k, v in load_info.items() ))
+
+    def get_new_datasetspecs(self, datasets):
+        specs = list(super().get_new_datasetspecs(datasets))
+        if self.concurrent_backfill:
+            self.pending_load_infos = [ load_info for load_info, _ in specs ]
+            pending_keys = set(map(self.period_key, self.pending_load_infos))
+            for key in list(self.prefetched):
+                if key not in pending_keys:
+                    self.discard_prefetched(key)
+        return specs
+
+    def get_spool(self, load_info):
+        ''' Returns the spool for ``load_info``, waiting for its prefetch, or None if it was not prefetched. Starts prefetching the periods queued after it either way. '''
+        key = self.period_key(load_info)
+        future = self.prefetched.pop(key, None)
+        self.prefetch_following(key)
+        if future is None:
+            return None
+        print(f"Using prefetched data for {load_info}", file=sys.stderr)
+        return future.result()
+
+    def prefetch_following(self, key):
+        keys = [ self.period_key(load_info) for load_info in self.pending_load_infos ]
+        if key not in keys:
+            return
+        i = keys.index(key)
+        for load_info in self.pending_load_infos[i+1:i+self.max_concurrent_periods]:
+            following_key = self.period_key(load_info)
+            if following_key not in self.prefetched:
+                print(f"Prefetching {load_info}", file=sys.stderr)
+                self.prefetched[following_key] = self.prefetch_pool.submit(self.spool_period, load_info)
+
+    def discard_prefetched(self, key):
+        def cleanup(future):
+            if future.exception() is None:
+                future.result().cleanup()
+        self.prefetched.pop(key).add_done_callback(cleanup)
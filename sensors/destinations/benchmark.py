@@ -0,0 +1,199 @@
+''' Offline throughput benchmark for the destination classes.
+
+Feeds synthetic rows through the same calls the sensors make (``set_column_format``, ``prepare``, ``PartLoader.put`` and ``finish``) with S3 uploads going to a local directory and BigQuery loads replaced by a stub that only counts bytes. The ``file`` destination is used as it is, writing into a temporary directory. Reports rows/sec, bytes/row and peak RSS. Each combination of destination and format runs in its own process.
+
+Run from the ``sensors`` directory, e.g.::
+
+    python -m destinations.benchmark --destination s3 --format gz,parquet --rows 1000000
+    python -m destinations.benchmark --row-type dict --destination bq --types int,string,date --null-ratio 0.3
+
+``--row-type tuple`` gives rows the way the ODBC sensor fetches them, ``--row-type dict`` the way the Salesforce sensor gets records.
+'''
+
+import os, sys, time, json, random, shutil, tempfile, argparse, resource, datetime, decimal, collections, concurrent.futures
+
+# name: (column type, value generator)
+COLUMN_TYPES = collections.OrderedDict([
+    ('int', ('int64', lambda r: r.randint(-2**40, 2**40))),
+    ('float', ('float64', lambda r: r.random() * 1e6)),
+    ('string', ('string', lambda r: ''.join(r.choices('abcdefghijklmnopqrstuvwxyz ', k=r.randint(5, 40))))),
+    ('date', ('date', lambda r: datetime.date(2000, 1, 1) + datetime.timedelta(days=r.randint(0, 9000)))),
+    ('timestamp', ('timestamp', lambda r: datetime.datetime(2000, 1, 1) + datetime.timedelta(seconds=r.randint(0, 9*10**8)))),
+    ('decimal', ('decimal', lambda r: decimal.Decimal(r.randint(0, 10**9)) / 100)),
+    ('bool', ('bool', lambda r: r.random() < 0.5)),
+    ('bytes', ('bytes', lambda r: r.randbytes(16) if hasattr(r, 'randbytes') else os.urandom(16))),
+])
+
+# --format: (compression, output_format) of the sensor
+FORMATS = {
+    'json': (None, 'json'),
+    'gz': ('gz', 'json'),
+    'zstd': ('zstd', 'json'),
+    'parquet': ('parquet', 'parquet'),
+    'avro': ('avro', 'avro'),
+}
+
+class LocalS3Commands(object):
+    ''' Stands in for ``treldev.S3Commands``. "Uploads" copy the file under ``root``. '''
+
+    def __init__(self, root):
+        self.root = root
+        self.uploaded_bytes = 0
+
+    def get_path(self, uri):
+        _, _, bucket, key = uri.split('/', 3)
+        return os.path.join(self.root, bucket, key)
+
+    def upload_file(self, filename, uri):
+        path = self.get_path(uri)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        shutil.copyfile(filename, path)
+        self.uploaded_bytes += os.path.getsize(path)
+
+    def load_file_as_string(self, bucket, key):
+        with open(os.path.join(self.root, bucket, key)) as f:
+            return f.read()
+
+class BenchmarkSensor(object):
+    ''' The sensor attributes the destination classes read. '''
+
+    def __init__(self, args, stand_in):
+        self.compression, self.output_format = FORMATS[args.format]
+        self.streaming_upload = False
+        self.bigquery_write_mode = 'load'
+        self.metrics_textfile = None
+        self.compression_threads = args.compression_threads
+        self.credentials = None
+        self.stand_in = stand_in
+
+def make_column_specs(args):
+    ''' Returns ``width`` (name, type) pairs cycling through ``types``. '''
+    types = args.types.split(',')
+    for t in types:
+        if t not in COLUMN_TYPES:
+            raise SystemExit(f"Unknown type {t}. Use some of {','.join(COLUMN_TYPES)}")
+    return [ (f"c{i}_{types[i % len(types)]}", types[i % len(types)]) for i in range(args.width) ]
+
+def make_rows(args, specs):
+    ''' Builds a pool of distinct rows that the benchmark cycles through, so generating data is not measured. '''
+    r = random.Random(args.seed)
+    pool = []
+    for _ in range(min(args.rows, args.pool_rows)):
+        row = tuple( None if r.random() < args.null_ratio else COLUMN_TYPES[t][1](r) for _, t in specs )
+        if args.row_type == 'dict':
+            row = dict(zip([ name for name, _ in specs ], row), attributes={'type': 'Bench'})
+        pool.append(row)
+    return pool
+
+def get_destinations():
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+    import destinations
+
+    class S3(destinations.S3Destination):
+        def prepare_inner(self):
+            self.s3_commands = self.sensor.stand_in
+
+        def read_string(self, name):
+            return self.sensor.stand_in.load_file_as_string(self.bucket, self.prefix+name)
+
+        def delete(self, name):
+            pass
+
+    class BigQuery(destinations.BigQueryDestination):
+        def prepare_inner(self):
+            pass
+
+        def upload_data_inner(self, filename, batch_num):
+            self.sensor.stand_in.uploaded_bytes += os.path.getsize(filename)
+            os.remove(filename)
+
+        def finish_inner(self):
+            pass
+
+    return destinations, {'s3': S3, 'bq': BigQuery, 'file': destinations.FileDestination}
+
+def run(args, destination_name, format_):
+    args = argparse.Namespace(**vars(args))
+    args.format = format_
+    specs = make_column_specs(args)
+    pool = make_rows(args, specs)
+    root = tempfile.mkdtemp(prefix='trel_bench_')
+    stand_in = LocalS3Commands(root)
+    try:
+        destinations, classes = get_destinations()
+        sensor = BenchmarkSensor(args, stand_in)
+        if destination_name == 'file':
+            destination = classes['file'](f"file://{root}/file/", sensor)
+        else:
+            destination = classes[destination_name](f"{destination_name}://bench/{destination_name}/", sensor)
+        destination.set_column_format([ {'name': name, 'type': COLUMN_TYPES[t][0], 'precision': 18, 'scale': 2}
+                                        for name, t in specs ])
+        destination.prepare()
+        loader = destinations.PartLoader(destination)
+
+        start = time.perf_counter()
+        remaining = args.rows
+        pool_i = 0
+        while remaining > 0:
+            batch_rows = min(remaining, args.batch_rows)
+            rows = []
+            for _ in range(batch_rows):
+                rows.append(pool[pool_i])
+                pool_i = (pool_i + 1) % len(pool)
+            loader.put([rows])
+            remaining -= batch_rows
+        loader.close()
+        destination.finish()
+        seconds = time.perf_counter() - start
+        if destination_name == 'file':
+            stand_in.uploaded_bytes = sum( os.path.getsize(os.path.join(root, 'file', name))
+                                           for name in os.listdir(os.path.join(root, 'file')) )
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+    return {
+        'row_type': args.row_type,
+        'destination': destination_name,
+        'format': format_,
+        'rows': args.rows,
+        'width': args.width,
+        'types': args.types,
+        'null_ratio': args.null_ratio,
+        'seconds': round(seconds, 3),
+        'rows_per_sec': round(args.rows / seconds),
+        'bytes_per_row': round(stand_in.uploaded_bytes / max(1, args.rows), 1),
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the destination classes against local stand-ins")
+    parser.add_argument("--row-type", dest='row_type', choices=('tuple', 'dict'), default='tuple')
+    parser.add_argument("--destination", default='s3,bq', help="comma separated: s3, bq, file")
+    parser.add_argument("--format", default='json,gz,parquet', help="comma separated: json, gz, zstd, parquet, avro. gz and zstd are s3 and file only")
+    parser.add_argument("--compression-threads", dest='compression_threads', type=int, default=None)
+    parser.add_argument("--rows", type=int, default=200000)
+    parser.add_argument("--batch-rows", dest='batch_rows', type=int, default=100000)
+    parser.add_argument("--width", type=int, default=20)
+    parser.add_argument("--types", default='int,float,string,date,timestamp,decimal,bool')
+    parser.add_argument("--null-ratio", dest='null_ratio', type=float, default=0.1)
+    parser.add_argument("--pool-rows", dest='pool_rows', type=int, default=10000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action='store_true', help="print one JSON line per run instead of a table")
+    return parser.parse_args(argv)
+
+if __name__ == '__main__':
+    cli_args = parse_args()
+    header = ('row_type', 'destination', 'format', 'rows_per_sec', 'bytes_per_row', 'peak_rss_mb', 'seconds')
+    if not cli_args.json:
+        print(''.join(f"{h:>14}" for h in header))
+    for destination_name in cli_args.destination.split(','):
+        for format_ in cli_args.format.split(','):
+            if format_ in ('gz', 'zstd') and destination_name == 'bq':
+                continue
+            # a fresh process per run, so that peak RSS belongs to that run
+            with concurrent.futures.ProcessPoolExecutor(1) as pool:
+                result = pool.submit(run, cli_args, destination_name, format_).result()
+            if cli_args.json:
+                print(json.dumps(result))
+            else:
+                print(''.join(f"{result[h]:>14}" for h in header))
+            sys.stdout.flush()
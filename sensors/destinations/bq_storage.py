@@ -0,0 +1,301 @@
+''' BigQuery Storage Write API support for the BigQuery destinations.
+
+Rows are sent as Arrow record batches to one pending write stream per thread, and all streams are committed together, so the table only shows the data once the whole load has succeeded.
+'''
+
+import sys, threading, datetime, decimal, base64, unittest, queue, collections
+from types import SimpleNamespace
+
+def get_arrow_type(bq_type):
+    ''' Returns the Arrow type that the Storage Write API accepts for a BigQuery column type. '''
+    import pyarrow as pa
+    bq_type = bq_type.upper()
+    if bq_type in ('INTEGER', 'INT64'):
+        return pa.int64()
+    if bq_type in ('FLOAT', 'FLOAT64'):
+        return pa.float64()
+    if bq_type in ('NUMERIC', 'DECIMAL'):
+        return pa.decimal128(38, 9)
+    if bq_type in ('BOOLEAN', 'BOOL'):
+        return pa.bool_()
+    if bq_type == 'BYTES':
+        return pa.binary()
+    if bq_type == 'DATE':
+        return pa.date32()
+    if bq_type == 'TIME':
+        return pa.time64('us')
+    if bq_type == 'DATETIME':
+        return pa.timestamp('us')
+    if bq_type == 'TIMESTAMP':
+        return pa.timestamp('us', tz='UTC')
+    return pa.string()
+
+NUMERIC_SCALE = decimal.Decimal('1e-9')
+
+def to_numeric(v):
+    return decimal.Decimal(v).quantize(NUMERIC_SCALE)
+
+def to_date(v):
+    return datetime.date.fromisoformat(v) if isinstance(v, str) else v
+
+def to_datetime(v):
+    return datetime.datetime.fromisoformat(v) if isinstance(v, str) else v
+
+def to_time(v):
+    return datetime.time.fromisoformat(v) if isinstance(v, str) else v
+
+def to_bytes(v):
+    return base64.b64decode(v) if isinstance(v, str) else v
+
+def get_arrow_converter(arrow_type):
+    ''' Returns the function that turns a non-null source value into one Arrow accepts for ``arrow_type``, or None. Handles both driver values and their JSON encodings (ISO dates, base64 bytes). '''
+    import pyarrow as pa
+    if pa.types.is_decimal(arrow_type):
+        return to_numeric
+    if pa.types.is_date(arrow_type):
+        return to_date
+    if pa.types.is_timestamp(arrow_type):
+        return to_datetime
+    if pa.types.is_time(arrow_type):
+        return to_time
+    if pa.types.is_binary(arrow_type):
+        return to_bytes
+    if pa.types.is_integer(arrow_type):
+        return int
+    return None
+
+class AppendConnection(object):
+    ''' The one ``append_rows`` call that feeds a write stream. Requests are queued to it, and up to ``max_in_flight`` of them wait for their response, whose offset and errors are checked as it arrives. '''
+
+    def __init__(self, client, stream_name, max_in_flight):
+        self.stream_name = stream_name
+        self.max_in_flight = max_in_flight
+        self.requests = queue.Queue()
+        self.offsets = collections.deque() # of the requests waiting for their response
+        self.responses = iter(client.append_rows(self.request_iterator(),
+                                                 metadata=(('x-goog-request-params', f"write_stream={stream_name}"),)))
+
+    def request_iterator(self):
+        while True:
+            request = self.requests.get()
+            if request is None:
+                return
+            yield request
+
+    def send(self, request):
+        self.requests.put(request)
+        self.offsets.append(request.offset)
+        while len(self.offsets) > self.max_in_flight:
+            self.receive()
+
+    def receive(self):
+        offset = self.offsets.popleft()
+        try:
+            response = next(self.responses)
+        except StopIteration:
+            response = None
+        if response is None or response.error.code:
+            self.requests.put(None)
+            if response is None:
+                raise Exception(f"Append to {self.stream_name} ended before the response for offset {offset}")
+            raise Exception(f"Append to {self.stream_name} at offset {offset} failed: {response.error.message} {list(response.row_errors)}")
+        if response.append_result.offset is not None and response.append_result.offset != offset:
+            self.requests.put(None)
+            raise Exception(f"Append to {self.stream_name} was acknowledged at offset {response.append_result.offset} instead of {offset}")
+
+    def close(self):
+        ''' Waits for the responses to the requests sent, then ends the call. '''
+        try:
+            while self.offsets:
+                self.receive()
+        finally:
+            self.requests.put(None)
+
+class PendingStreamWriter(object):
+    ''' Appends Arrow record batches to pending write streams of ``table_path`` (``projects/p/datasets/d/tables/t``). Each thread gets its own stream, with its own offsets, so appends can run in parallel. Each stream is fed by a single ``append_rows`` call for the whole load. ``commit`` finalizes and commits all streams at once. '''
+
+    max_request_bytes = 8 * 1024 * 1024 # the API limit is 10MB per request
+    max_in_flight = 4 # requests sent on a stream before waiting for the first response
+
+    def __init__(self, table_path, arrow_schema, client=None, credentials=None):
+        from google.cloud.bigquery_storage_v1 import types
+        self.types = types
+        if client is None:
+            from google.cloud import bigquery_storage_v1
+            client = bigquery_storage_v1.BigQueryWriteClient(credentials=credentials)
+        self.client = client
+        self.table_path = table_path
+        self.serialized_schema = arrow_schema.serialize().to_pybytes()
+        self.local = threading.local()
+        self.streams = []
+        self.connections = []
+        self.lock = threading.Lock()
+
+    def get_stream(self):
+        if getattr(self.local, 'stream', None) is None:
+            stream = self.client.create_write_stream(
+                parent=self.table_path,
+                write_stream=self.types.WriteStream(type_=self.types.WriteStream.Type.PENDING))
+            self.local.stream = stream
+            self.local.offset = 0
+            self.local.connection = AppendConnection(self.client, stream.name, self.max_in_flight)
+            with self.lock:
+                self.streams.append(stream.name)
+                self.connections.append(self.local.connection)
+            print(f"Opened pending write stream {stream.name}", file=sys.stderr)
+        return self.local.stream
+
+    def append(self, record_batch):
+        stream = self.get_stream()
+        if record_batch.num_rows == 0:
+            return
+        rows_per_request = max(1, int(record_batch.num_rows * self.max_request_bytes / max(1, record_batch.nbytes)))
+        for start in range(0, record_batch.num_rows, rows_per_request):
+            chunk = record_batch.slice(start, rows_per_request)
+            request = self.types.AppendRowsRequest(
+                write_stream=stream.name,
+                offset=self.local.offset,
+                arrow_rows=self.types.AppendRowsRequest.ArrowData(
+                    writer_schema=self.types.ArrowSchema(serialized_schema=self.serialized_schema),
+                    rows=self.types.ArrowRecordBatch(serialized_record_batch=chunk.serialize().to_pybytes(),
+                                                     row_count=chunk.num_rows)))
+            self.local.connection.send(request)
+            self.local.offset += chunk.num_rows
+
+    def commit(self):
+        if not self.streams:
+            return
+        for connection in self.connections:
+            connection.close()
+        for name in self.streams:
+            self.client.finalize_write_stream(name=name)
+        response = self.client.batch_commit_write_streams(
+            self.types.BatchCommitWriteStreamsRequest(parent=self.table_path, write_streams=self.streams))
+        if response.stream_errors:
+            raise Exception(f"Committing write streams to {self.table_path} failed: {list(response.stream_errors)}")
+        print(f"Committed {len(self.streams)} write streams to {self.table_path}", file=sys.stderr)
+
+def get_table_path(bq_path):
+    ''' Turns ``project.dataset.table`` into the ``projects/p/datasets/d/tables/t`` form used by the Storage API. '''
+    project, dataset, table = bq_path.replace(':', '.').split('.')
+    return f"projects/{project}/datasets/{dataset}/tables/{table}"
+
+class FakeWriteClient(object):
+    ''' Records the calls ``PendingStreamWriter`` makes to a ``BigQueryWriteClient``, for the tests. '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.created = []
+        self.requests = []
+        self.calls = 0
+        self.finalized = []
+        self.commits = []
+
+    def create_write_stream(self, parent, write_stream):
+        with self.lock:
+            stream = SimpleNamespace(name=f"{parent}/streams/{len(self.created)}", type_=write_stream.type_)
+            self.created.append(stream)
+        return stream
+
+    def append_rows(self, requests, metadata=()):
+        with self.lock:
+            self.calls += 1
+        def responses():
+            for request in requests:
+                with self.lock:
+                    self.requests.append(request)
+                yield SimpleNamespace(error=SimpleNamespace(code=0, message=''), row_errors=[],
+                                      append_result=SimpleNamespace(offset=request.offset))
+        return responses()
+
+    def finalize_write_stream(self, name):
+        self.finalized.append(name)
+
+    def batch_commit_write_streams(self, request):
+        self.commits.append(request)
+        return SimpleNamespace(stream_errors=[])
+
+class Test(unittest.TestCase):
+
+    table_path = 'projects/p/datasets/d/tables/t'
+
+    def make_writer(self):
+        import pyarrow as pa
+        self.schema = pa.schema([pa.field('id', pa.int64()), pa.field('name', pa.string())])
+        self.client = FakeWriteClient()
+        return PendingStreamWriter(self.table_path, self.schema, client=self.client)
+
+    def make_batch(self, ids):
+        import pyarrow as pa
+        return pa.record_batch([pa.array(ids, pa.int64()), pa.array([ f"name {i}" for i in ids ])], schema=self.schema)
+
+    def read_ids(self, request):
+        import pyarrow as pa
+        batch = pa.ipc.read_record_batch(pa.py_buffer(request.arrow_rows.rows.serialized_record_batch), self.schema)
+        self.assertEqual(batch.num_rows, request.arrow_rows.rows.row_count)
+        return batch.column(0).to_pylist()
+
+    def test_offsets(self):
+        writer = self.make_writer()
+        writer.append(self.make_batch(range(0, 10)))
+        writer.append(self.make_batch([]))
+        writer.append(self.make_batch(range(10, 25)))
+        writer.commit()
+        self.assertEqual(len(self.client.created), 1)
+        self.assertEqual(self.client.calls, 1)
+        self.assertEqual([ request.offset for request in self.client.requests ], [0, 10])
+        self.assertEqual([ request.write_stream for request in self.client.requests ], [self.client.created[0].name] * 2)
+        self.assertEqual(sum(map(self.read_ids, self.client.requests), []), list(range(25)))
+
+    def test_request_chunking(self):
+        writer = self.make_writer()
+        batch = self.make_batch(range(1000))
+        writer.max_request_bytes = batch.nbytes // 10
+        writer.append(batch)
+        # responses are read as the requests go, a few behind
+        self.assertGreaterEqual(len(self.client.requests), 10 - writer.max_in_flight)
+        writer.commit()
+        self.assertGreater(len(self.client.requests), 9)
+        self.assertEqual(self.client.calls, 1)
+        offsets = [ request.offset for request in self.client.requests ]
+        row_counts = [ request.arrow_rows.rows.row_count for request in self.client.requests ]
+        self.assertEqual(offsets, [ sum(row_counts[:i]) for i in range(len(row_counts)) ])
+        self.assertEqual(sum(map(self.read_ids, self.client.requests), []), list(range(1000)))
+
+    def test_stream_per_thread(self):
+        writer = self.make_writer()
+        barrier = threading.Barrier(3)
+        def run(first):
+            barrier.wait() # all threads are alive at once, so none can reuse another's thread-local stream
+            writer.append(self.make_batch(range(first, first + 10)))
+            writer.append(self.make_batch(range(first + 10, first + 20)))
+        threads = [ threading.Thread(target=run, args=(i * 100,)) for i in range(3) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        writer.commit()
+        self.assertEqual(len(self.client.created), 3)
+        self.assertEqual(self.client.calls, 3)
+        self.assertEqual(sorted(writer.streams), sorted( stream.name for stream in self.client.created ))
+        for stream in self.client.created:
+            requests = [ request for request in self.client.requests if request.write_stream == stream.name ]
+            self.assertEqual([ request.offset for request in requests ], [0, 10])
+            ids = sum(map(self.read_ids, requests), [])
+            self.assertEqual(ids, list(range(ids[0], ids[0] + 20)))
+
+    def test_commit(self):
+        writer = self.make_writer()
+        writer.commit()
+        self.assertEqual(self.client.commits, [])
+        threads = [ threading.Thread(target=writer.append, args=(self.make_batch([i]),)) for i in range(2) ]
+        for thread in threads:
+            thread.start()
+            thread.join()
+        writer.commit()
+        names = [ stream.name for stream in self.client.created ]
+        self.assertEqual(len(names), 2)
+        self.assertEqual(self.client.finalized, names)
+        self.assertEqual(len(self.client.commits), 1)
+        self.assertEqual(self.client.commits[0].parent, self.table_path)
+        self.assertEqual(list(self.client.commits[0].write_streams), names)
@@ -0,0 +1,125 @@
+''' Compressors applied to encoded part files, or wrapped around the upload stream when parts are streamed.
+
+Compression happens in the sensor's process on ``threads`` threads: the data is cut into blocks that are compressed independently, and the compressed blocks are written in order. Both gzip members and zstd frames can be concatenated, so the result is a regular .gz or .zst file that any reader decompresses as a whole.
+'''
+
+import os, io, gzip, shutil, threading, collections, concurrent.futures
+
+class Compressor(object):
+    ''' No compression. ``suffix`` is appended to part names. '''
+
+    name = None
+    suffix = ''
+    registered = {}
+    block_bytes = 4*1024*1024
+
+    @classmethod
+    def register(cls):
+        cls.registered[cls.name] = cls
+
+    def __init__(self, level=None, threads=None):
+        self.level = level
+        self.threads = threads or os.cpu_count() or 1
+
+    def compress_file(self, filename):
+        ''' Compresses ``filename`` and returns the name of the compressed file, removing the original. '''
+        if self.name is None:
+            return filename
+        with open(filename, 'rb') as src, open(filename + self.suffix, 'wb') as dst:
+            writer = self.wrap(dst)
+            shutil.copyfileobj(src, writer, self.block_bytes)
+            writer.close()
+        os.remove(filename)
+        return filename + self.suffix
+
+    def wrap(self, f, max_buffer_bytes=None):
+        ''' Returns a binary file object compressing into ``f``. Closing it must not close ``f``. With ``max_buffer_bytes``, at most that much uncompressed data is held at once, in smaller blocks if need be. '''
+        if self.name is None:
+            return f
+        return BlockWriter(f, self.compress_block, self.threads, self.block_bytes, max_buffer_bytes)
+
+    def compress_block(self, block):
+        raise NotImplementedError()
+Compressor.register()
+
+def get_compressor(name, level=None, threads=None):
+    try:
+        return Compressor.registered[name](level, threads)
+    except KeyError:
+        raise Exception(f"Unknown compression {name}. Only found {sorted(map(str, Compressor.registered))}")
+
+class BlockWriter(io.RawIOBase):
+    ''' Compresses what is written to it in blocks of ``block_bytes`` on a pool of ``threads`` threads and writes the compressed blocks to ``f`` in order. At most two blocks per thread are held in memory. With ``max_buffer_bytes``, no more blocks are held than fit in it, counting the block being filled, and blocks are made smaller so that at least two fit. '''
+
+    def __init__(self, f, compress_block, threads, block_bytes, max_buffer_bytes=None):
+        super().__init__()
+        self.f = f
+        self.compress_block = compress_block
+        self.buffer = bytearray()
+        self.pool = concurrent.futures.ThreadPoolExecutor(threads)
+        self.max_pending = 2 * threads
+        if max_buffer_bytes is not None:
+            block_bytes = min(block_bytes, max(1, max_buffer_bytes // 2))
+            self.max_pending = min(self.max_pending, max_buffer_bytes // block_bytes - 1)
+        self.block_bytes = block_bytes
+        self.pending = collections.deque()
+        self.num_blocks = 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.buffer += b
+        while len(self.buffer) >= self.block_bytes:
+            self.submit(bytes(self.buffer[:self.block_bytes]))
+            del self.buffer[:self.block_bytes]
+        return len(b)
+
+    def submit(self, block):
+        self.pending.append(self.pool.submit(self.compress_block, block))
+        self.num_blocks += 1
+        while len(self.pending) > self.max_pending:
+            self.f.write(self.pending.popleft().result())
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self.buffer or self.num_blocks == 0:
+                self.submit(bytes(self.buffer))
+                self.buffer = bytearray()
+            while self.pending:
+                self.f.write(self.pending.popleft().result())
+        finally:
+            self.pool.shutdown()
+            super().close()
+
+class GzipCompressor(Compressor):
+    ''' Each block is a gzip member. ``level`` defaults to 6, as for the gzip command. '''
+
+    name = 'gz'
+    suffix = '.gz'
+
+    def compress_block(self, block):
+        return gzip.compress(block, compresslevel=6 if self.level is None else self.level, mtime=0)
+GzipCompressor.register()
+
+class ZstdCompressor(Compressor):
+    ''' Each block is a zstd frame. ``level`` defaults to 3. Needs the zstandard package. '''
+
+    name = 'zstd'
+    suffix = '.zst'
+
+    def __init__(self, level=None, threads=None):
+        global zstandard
+        import zstandard
+        super().__init__(level, threads)
+        self.local = threading.local()
+
+    def compress_block(self, block):
+        # compressor objects are not thread safe, so each thread keeps its own
+        compressor = getattr(self.local, 'compressor', None)
+        if compressor is None:
+            compressor = self.local.compressor = zstandard.ZstdCompressor(level=3 if self.level is None else self.level)
+        return compressor.compress(block)
+ZstdCompressor.register()
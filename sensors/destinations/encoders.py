@@ -0,0 +1,261 @@
+''' Encoders turn batches of rows into the bytes of a part file.
+
+A batch is given column-wise: one list of values per destination column, in the order of ``destination.columns``. Encoders are picked by name through ``get_encoder``; destinations decide which one to use in ``get_format``.
+'''
+
+import json, base64, decimal
+from . import bq_storage
+
+try:
+    import orjson
+    json_dumps_bytes = orjson.dumps
+    def json_dumps(obj):
+        return orjson.dumps(obj).decode('utf-8')
+except ImportError:
+    json_dumps = json.dumps
+    def json_dumps_bytes(obj):
+        return json.dumps(obj).encode('utf-8')
+
+def encode_base64(value):
+    return base64.b64encode(value).decode('utf-8')
+
+# a column whose values all have these types needs no conversion to strings
+plain_string_types = frozenset((str, type(None)))
+
+def to_json_string(value):
+    ''' For string columns holding structured values, such as Salesforce compound fields. '''
+    return value if isinstance(value, str) else json_dumps(value)
+
+class Encoder(object):
+    ''' Writes batches to a file object, opened in binary mode if ``binary`` is set. ``suffix`` is appended to part names. A batch is a list of columns, each a list of values or, for encoders with ``arrow_input`` set, possibly an Arrow array. '''
+
+    name = None
+    suffix = ''
+    binary = False
+    arrow_input = False
+    registered = {}
+
+    @classmethod
+    def register(cls):
+        cls.registered[cls.name] = cls
+
+    def __init__(self, destination):
+        self.destination = destination
+
+    def encode(self, batches, f):
+        raise NotImplementedError()
+
+def get_encoder(name):
+    try:
+        return Encoder.registered[name]
+    except KeyError:
+        raise Exception(f"Unknown format {name}. Only found {sorted(Encoder.registered)}")
+
+class JSONEncoder(Encoder):
+    ''' JSON lines. Null values are left out. Lines are written as UTF-8 bytes, straight from orjson when it is installed. '''
+
+    name = 'json'
+    binary = True
+    json_converters = {
+        'date': str,
+        'time': str,
+        'timestamp': str,
+        'decimal': str,
+        'interval': str,
+        'bytes': encode_base64,
+        }
+
+    def __init__(self, destination):
+        super().__init__(destination)
+        self.names = [ column['name'] for column in destination.columns ]
+        self.converters = [ self.json_converters.get(column['type']) for column in destination.columns ]
+
+    def encode(self, batches, f):
+        names = self.names
+        for columns in batches:
+            columns = [ values if converter is None or (converter is str and set(map(type, values)) <= plain_string_types)
+                        else [ None if v is None else converter(v) for v in values ]
+                        for values, converter in zip(columns, self.converters) ]
+            lines = [ json_dumps_bytes({ k: v for k, v in zip(names, row) if v is not None }) for row in zip(*columns) ]
+            if lines:
+                lines.append(b'')
+                f.write(b'\n'.join(lines))
+JSONEncoder.register()
+
+def to_arrow_array(values, arrow_type):
+    ''' Builds an Arrow array from Python values in one call. Columns given as strings, such as ISO dates from an API, are parsed by casting the whole column, and decimals with more digits than the scale of ``arrow_type`` are rounded. '''
+    try:
+        return pa.array(values, type=arrow_type)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        if not pa.types.is_decimal(arrow_type):
+            return pa.array(values, type=pa.string()).cast(arrow_type)
+    exponent = decimal.Decimal(1).scaleb(-arrow_type.scale)
+    return pa.array([ None if v is None else decimal.Decimal(v if isinstance(v, (str, int, decimal.Decimal)) else str(v)).quantize(exponent)
+                      for v in values ], type=arrow_type)
+
+class ArrowEncoder(Encoder):
+    ''' Base of the encoders going through Arrow RecordBatches, using the destination's ``get_arrow_schema`` and ``get_arrow_converter``. Values without a converter are converted a column at a time by ``to_arrow_array``. Columns that are already Arrow arrays are cast to the schema, and only go through Python values when Arrow can not cast them. '''
+
+    binary = True
+    arrow_input = True
+
+    def __init__(self, destination):
+        global pa
+        import pyarrow as pa
+        super().__init__(destination)
+        self.schema = destination.get_arrow_schema()
+        self.converters = [ destination.get_arrow_converter(column, field)
+                            for column, field in zip(destination.columns, self.schema) ]
+
+    def to_record_batch(self, columns):
+        arrays = []
+        for values, field, converter in zip(columns, self.schema, self.converters):
+            if isinstance(values, pa.Array):
+                try:
+                    arrays.append(values if values.type == field.type else values.cast(field.type))
+                    continue
+                except (pa.ArrowInvalid, pa.ArrowNotImplementedError, pa.ArrowTypeError):
+                    values = values.to_pylist()
+            if converter is not None:
+                values = [ None if v is None else converter(v) for v in values ]
+            arrays.append(to_arrow_array(values, field.type))
+        return pa.RecordBatch.from_arrays(arrays, schema=self.schema)
+
+class ParquetEncoder(ArrowEncoder):
+    ''' Parquet files with row groups of up to ``parquet_row_group_rows`` rows, compressed with ``parquet_compression`` (snappy, zstd, gzip or none) at ``parquet_compression_level``. '''
+
+    name = 'parquet'
+    suffix = '.parquet'
+
+    def __init__(self, destination):
+        global pq
+        import pyarrow.parquet as pq
+        super().__init__(destination)
+        self.row_group_rows = destination.get_option('parquet_row_group_rows', 1000000)
+        self.compression = destination.get_option('parquet_compression', 'snappy')
+        self.compression_level = destination.get_option('parquet_compression_level')
+
+    def encode(self, batches, f):
+        pq.write_table(pa.Table.from_batches([ self.to_record_batch(columns) for columns in batches ], schema=self.schema), f,
+                       row_group_size=self.row_group_rows, compression=self.compression,
+                       compression_level=self.compression_level)
+
+    def open_writer(self, f, max_pending_bytes=None):
+        ''' Returns a ``ParquetPartWriter`` for writing one part to ``f`` a few batches at a time. '''
+        return ParquetPartWriter(self, f, max_pending_bytes)
+ParquetEncoder.register()
+
+class ParquetPartWriter(object):
+    ''' Keeps a ``ParquetWriter`` open on one part. Batches are buffered until they make up a row group of ``row_group_rows``, or of ``max_pending_bytes`` in memory if given, so the part gets one footer and full row groups however small the batches are. '''
+
+    def __init__(self, encoder, f, max_pending_bytes=None):
+        self.encoder = encoder
+        self.writer = pq.ParquetWriter(f, encoder.schema, compression=encoder.compression,
+                                       compression_level=encoder.compression_level)
+        self.max_pending_bytes = max_pending_bytes
+        self.pending = []
+        self.pending_rows = 0
+        self.pending_bytes = 0
+        self.num_rows = 0
+
+    def write(self, columns):
+        batch = self.encoder.to_record_batch(columns)
+        self.pending.append(batch)
+        self.pending_rows += batch.num_rows
+        self.pending_bytes += batch.nbytes
+        self.num_rows += batch.num_rows
+        if (self.pending_rows >= self.encoder.row_group_rows
+            or self.max_pending_bytes is not None and self.pending_bytes >= self.max_pending_bytes):
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        self.writer.write_table(pa.Table.from_batches(self.pending, schema=self.encoder.schema),
+                                row_group_size=self.encoder.row_group_rows)
+        self.pending = []
+        self.pending_rows = 0
+        self.pending_bytes = 0
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+class ArrowStreamEncoder(ArrowEncoder):
+    ''' The Arrow IPC stream format, read back by uploaders that send record batches, such as the BigQuery Storage Write API. '''
+
+    name = 'arrow'
+    suffix = '.arrows'
+
+    def encode(self, batches, f):
+        with pa.ipc.new_stream(f, self.schema) as writer:
+            for columns in batches:
+                writer.write_batch(self.to_record_batch(columns))
+ArrowStreamEncoder.register()
+
+class AvroEncoder(Encoder):
+    ''' Avro object container files with deflate compression and logical types for dates, times, timestamps and decimals. Needs fastavro. '''
+
+    name = 'avro'
+    suffix = '.avro'
+    binary = True
+    avro_types = {
+        'int8': 'int',
+        'int16': 'int',
+        'int32': 'int',
+        'int64': 'long',
+        'float32': 'float',
+        'float64': 'double',
+        'bool': 'boolean',
+        'string': 'string',
+        'bytes': 'bytes',
+        'interval': 'string',
+        'date': {'type': 'int', 'logicalType': 'date'},
+        'time': {'type': 'long', 'logicalType': 'time-micros'},
+        'timestamp': {'type': 'long', 'logicalType': 'local-timestamp-micros'},
+        }
+
+    def __init__(self, destination):
+        global fastavro
+        import fastavro
+        super().__init__(destination)
+        self.names = [ column['name'] for column in destination.columns ]
+        self.schema = fastavro.parse_schema({
+            'type': 'record',
+            'name': 'Row',
+            'fields': [ {'name': column['name'], 'type': ['null', self.get_avro_type(column)], 'default': None}
+                        for column in destination.columns ],
+            })
+        self.converters = [ self.get_converter(column) for column in destination.columns ]
+
+    def get_avro_type(self, column):
+        if column['type'] == 'decimal':
+            return {'type': 'bytes', 'logicalType': 'decimal',
+                    'precision': column.get('precision') or 38, 'scale': column.get('scale') or 9}
+        return self.avro_types[column['type']]
+
+    def get_converter(self, column):
+        type_ = column['type']
+        if type_ == 'decimal':
+            exponent = decimal.Decimal(1).scaleb(-(column.get('scale') or 9))
+            return lambda v: decimal.Decimal(v).quantize(exponent)
+        if type_ in ('string', 'interval'):
+            return to_json_string
+        return {
+            'date': bq_storage.to_date,
+            'time': bq_storage.to_time,
+            'timestamp': bq_storage.to_datetime,
+            'bytes': bq_storage.to_bytes,
+            'int8': int,
+            }.get(type_)
+
+    def encode(self, batches, f):
+        names = self.names
+        def records():
+            for columns in batches:
+                columns = [ values if converter is None else [ None if v is None else converter(v) for v in values ]
+                            for values, converter in zip(columns, self.converters) ]
+                for row in zip(*columns):
+                    yield dict(zip(names, row))
+        fastavro.writer(f, self.schema, records(), codec='deflate')
+AvroEncoder.register()
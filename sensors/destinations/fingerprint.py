@@ -0,0 +1,41 @@
+''' Skipping the extraction of periods whose source has not changed.
+
+Before extracting, a sensor runs a cheap query summarizing the source, e.g. the row count and the latest modification time, and hashes it with ``make_fingerprint``. The hash is saved in the state of the dataset it loads. When the next period's hash matches the one saved with the newest earlier dataset, the period is completed by copying that dataset with ``DestinationProtocol.copy_from`` instead of reading the source again.
+'''
+
+import sys, json, hashlib
+from . import DestinationProtocol
+
+def make_fingerprint(*parts):
+    ''' Hashes JSON-able ``parts`` into a hex string. Other values, such as datetimes and decimals, are hashed as their ``str``. '''
+    return hashlib.sha256(json.dumps(parts, default=str).encode('utf-8')).hexdigest()
+
+class FingerprintMixin(object):
+    ''' Mix into a ``treldev.ClockBasedSensor`` subclass, before it in the bases. Keeps the datasets passed to ``get_new_datasetspecs`` as ``existing_datasets``, so that the state saved with earlier datasets can be read. '''
+
+    def get_new_datasetspecs(self, datasets):
+        self.existing_datasets = datasets
+        return super().get_new_datasetspecs(datasets)
+
+    def get_previous_states(self, instance_ts, dataset_class=None):
+        ''' Yields (uri, state) for the existing datasets older than ``instance_ts`` that have a state, newest first. With ``dataset_class``, only for datasets of that class. '''
+        previous = [ ds for ds in getattr(self, 'existing_datasets', [])
+                     if ds.get('uri') and str(ds['instance_ts']) < str(instance_ts)
+                     and (dataset_class is None or ds.get('dataset_class', dataset_class) == dataset_class) ]
+        for ds in sorted(previous, key=lambda ds: str(ds['instance_ts']), reverse=True):
+            state = DestinationProtocol.get_object_from_uri(ds['uri'], self).load_state()
+            if state:
+                yield ds['uri'], state
+
+    def copy_if_unchanged(self, uri, instance_ts, fingerprint, dataset_class=None):
+        ''' If the newest earlier dataset with a fingerprint has ``fingerprint``, completes ``uri`` as a copy of it, saving the same fingerprint, and returns True. '''
+        for previous_uri, state in self.get_previous_states(instance_ts, dataset_class):
+            if 'fingerprint' not in state:
+                continue
+            if state['fingerprint'] != fingerprint:
+                print(f"Source changed since {previous_uri}", file=sys.stderr)
+                return False
+            print(f"Source unchanged since {previous_uri}. Copying it to {uri}", file=sys.stderr)
+            DestinationProtocol.get_object_from_uri(uri, self).copy_from(previous_uri, {'fingerprint': fingerprint})
+            return True
+        return False
@@ -0,0 +1,73 @@
+''' Throughput instrumentation for dataset loads.
+
+A ``LoadMetrics`` object is created by the destination in ``prepare``. The sensor and the destination add counters and stage timings to it while the data moves, each uploaded part is reported as a JSON line on stderr, and ``emit`` reports the totals for the dataset as a JSON line and, optionally, as a Prometheus textfile. When one load writes to several destinations, the metrics of the others are ``include``d in those of the first, so that the textfile holds all of them, labelled by URI.
+'''
+
+import os, sys, json, time, threading, contextlib, re
+
+class LoadMetrics(object):
+    ''' Counters and timers of one dataset load. Safe to use from several threads.
+
+    Totals are named after what they count, e.g. ``rows_fetched``, ``bytes_uploaded`` and ``fetch_seconds``. '''
+
+    def __init__(self, uri, textfile=None):
+        self.uri = uri
+        self.textfile = textfile
+        self.lock = threading.Lock()
+        self.totals = {}
+        self.start = time.time()
+        self.included = []
+
+    def add(self, name, value):
+        with self.lock:
+            self.totals[name] = self.totals.get(name, 0) + value
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        ''' Adds the time spent in the block to ``<name>_seconds``. '''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name + '_seconds', time.perf_counter() - start)
+
+    def include(self, other):
+        ''' Writes the totals of ``other``, the metrics of another destination of the same load, with these in the textfile, instead of ``other`` replacing it. Call ``emit`` on ``other`` first. '''
+        other.textfile = None
+        self.included.append(other)
+
+    def get_totals(self):
+        with self.lock:
+            totals = dict(self.totals)
+        totals['elapsed_seconds'] = time.time() - self.start
+        return totals
+
+    def part(self, batch_num, **fields):
+        ''' Reports one uploaded part. '''
+        self.emit_line(dict(event='part', uri=self.uri, batch_num=batch_num, **fields))
+
+    def emit(self):
+        ''' Reports the totals of the load. Called once the dataset is complete. '''
+        totals = self.get_totals()
+        self.emit_line(dict(event='load', uri=self.uri, **totals))
+        if self.textfile:
+            self.write_textfile([ (self.uri, totals) ] + [ (other.uri, other.get_totals()) for other in self.included ])
+
+    def emit_line(self, record):
+        print(json.dumps(record, default=str), file=sys.stderr)
+
+    def write_textfile(self, samples):
+        ''' Writes (uri, totals) ``samples`` in the Prometheus text format, for the node exporter textfile collector. The file is replaced atomically. '''
+        names = sorted(set( name for _, totals in samples for name in totals ))
+        lines = []
+        for name in names:
+            metric = 'trel_sensor_' + re.sub('[^a-zA-Z0-9_]', '_', name)
+            lines.append(f"# TYPE {metric} gauge")
+            for uri, totals in samples:
+                if name in totals:
+                    label = uri.replace('\\', '\\\\').replace('"', '\\"')
+                    lines.append(f'{metric}{{uri="{label}"}} {totals[name]}')
+        tmp_name = self.textfile + '.tmp'
+        with open(tmp_name, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp_name, self.textfile)
@@ -0,0 +1,281 @@
+''' Batching and pipelining shared by the sensors.
+
+A part is a list of row chunks, e.g. the results of a few ``fetchmany`` calls. ``PartLoader`` moves parts into a prepared destination: encode, compress and upload, either serially or through a ``Pipeline`` of background threads so the source keeps streaming while earlier parts upload. ``PartSizer`` picks part sizes from measured bytes per row. ``FanoutLoader`` sends the same parts to several destinations.
+'''
+
+import os, sys, queue, threading, time, tempfile, concurrent.futures
+
+def parse_bytes(value):
+    ''' Turns sizes such as 256MB or 1GB into a number of bytes. Numbers are returned as they are. '''
+    if value is None or isinstance(value, int):
+        return value
+    value = str(value).strip().upper()
+    for suffix, multiplier in (('KB', 1024), ('MB', 1024**2), ('GB', 1024**3), ('B', 1)):
+        if value.endswith(suffix):
+            return int(float(value[:-len(suffix)]) * multiplier)
+    return int(value)
+
+class PartSizer(object):
+    ''' Picks rows per fetch and rows per part from measured sizes. Fetches are capped at ``max_fetch_bytes`` using the approximate in-memory size of recently fetched rows. Parts aim at ``target_part_bytes`` using the output size per row of finished parts, or the in-memory size until a part has finished. '''
+
+    probe_rows = 100
+    max_rows_per_fetch = 100000
+    sample_rows = 100
+
+    def __init__(self, target_part_bytes, max_fetch_bytes):
+        self.target_part_bytes = target_part_bytes
+        self.max_fetch_bytes = max_fetch_bytes
+        self.fetched_bytes_per_row = None
+        self.part_bytes_per_row = None
+        self.lock = threading.Lock()
+
+    def get_fetch_rows(self, part_rows):
+        ''' Rows to fetch next, given that the current part already has ``part_rows`` rows. '''
+        if self.fetched_bytes_per_row is None:
+            return self.probe_rows
+        return int(max(1, min(self.max_rows_per_fetch,
+                              self.max_fetch_bytes / self.fetched_bytes_per_row,
+                              self.get_part_rows() - part_rows)))
+
+    def get_part_rows(self):
+        bytes_per_row = self.part_bytes_per_row or self.fetched_bytes_per_row
+        return int(max(1, self.target_part_bytes / bytes_per_row))
+
+    def record_fetch(self, rows):
+        if getattr(rows, 'nbytes', None) is not None: # an Arrow RecordBatch
+            self.fetched_bytes_per_row = max(1, rows.nbytes / max(1, rows.num_rows))
+            return
+        step = max(1, len(rows) // self.sample_rows)
+        sample = rows[::step]
+        sample_bytes = sum( len(v) if isinstance(v, (str, bytes, bytearray)) else 8
+                            for row in sample for v in (row.values() if isinstance(row, dict) else row)
+                            if v is not None )
+        self.fetched_bytes_per_row = max(1, sample_bytes / len(sample))
+
+    def record_part(self, num_rows, num_bytes):
+        if num_rows == 0 or num_bytes is None:
+            return
+        with self.lock:
+            bytes_per_row = max(num_bytes / num_rows, 1e-3)
+            if self.part_bytes_per_row is None:
+                self.part_bytes_per_row = bytes_per_row
+            else:
+                self.part_bytes_per_row = (self.part_bytes_per_row + bytes_per_row) / 2
+        print(f"Part of {num_rows} rows is {num_bytes} bytes, now targeting {self.get_part_rows()} rows per part", file=sys.stderr)
+
+class Pipeline(object):
+    ''' Runs a chain of stages connected by bounded queues. Each stage is a (function, number of worker threads) pair and the return value of a stage is passed on to the next one. The first exception raised in any stage stops the pipeline and is re-raised by ``put`` or ``join``. With ``metrics``, the time spent waiting on full queues (``queue_put_wait_seconds``) and empty ones (``queue_get_wait_seconds``) is recorded. '''
+
+    DONE = object()
+
+    def __init__(self, stages, queue_depth, metrics=None):
+        self.metrics = metrics
+        self.queues = [ queue.Queue(queue_depth) for _ in stages ]
+        self.workers = [ workers for _, workers in stages ]
+        self.remaining = list(self.workers)
+        self.lock = threading.Lock()
+        self.error = None
+        self.threads = []
+        for stage_i, (func, workers) in enumerate(stages):
+            for _ in range(workers):
+                thread = threading.Thread(target=self.run_stage, args=(stage_i, func), daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+    def put(self, item, stage_i=0):
+        start = time.perf_counter()
+        while True:
+            if self.error is not None and stage_i == 0:
+                raise self.error
+            try:
+                self.queues[stage_i].put(item, timeout=1)
+                break
+            except queue.Full:
+                pass
+        if self.metrics is not None and item is not self.DONE:
+            self.metrics.add('queue_put_wait_seconds', time.perf_counter() - start)
+
+    def run_stage(self, stage_i, func):
+        while True:
+            start = time.perf_counter()
+            item = self.queues[stage_i].get()
+            if item is self.DONE:
+                break
+            if self.metrics is not None:
+                self.metrics.add('queue_get_wait_seconds', time.perf_counter() - start)
+            if self.error is not None:
+                continue # keep draining so upstream stages do not block
+            try:
+                result = func(item)
+                if stage_i + 1 < len(self.queues):
+                    self.put(result, stage_i + 1)
+            except BaseException as ex:
+                with self.lock:
+                    if self.error is None:
+                        self.error = ex
+        with self.lock:
+            self.remaining[stage_i] -= 1
+            last = self.remaining[stage_i] == 0
+        if last and stage_i + 1 < len(self.queues):
+            for _ in range(self.workers[stage_i + 1]):
+                self.put(self.DONE, stage_i + 1)
+
+    def join(self):
+        for _ in range(self.workers[0]):
+            self.queues[0].put(self.DONE)
+        for thread in self.threads:
+            thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def stop(self):
+        ''' Makes the stages skip the items still queued, as after an error, and waits for them. Does not raise. '''
+        with self.lock:
+            if self.error is None:
+                self.error = Exception("Pipeline stopped")
+        try:
+            self.join()
+        except BaseException:
+            pass
+
+class PartLoader(object):
+    ''' Sends parts to a prepared destination. Serially, ``put`` returns once the part is uploaded, with its size. With ``pipeline``, encoding (1 thread), compression (``compress_workers``) and upload (``upload_workers``) run in the background behind queues of ``queue_depth`` parts and ``put`` returns None. Destinations that stream parts do all three in one step. ``close`` waits for the pipeline and re-raises its first error; after an error, ``abort`` drops the parts still queued and cleans up instead.
+
+    With the ``parquet_part_bytes`` option and parquet output, a part no longer corresponds to a ``put``: each ``put`` is appended to an open part file, which is uploaded once it reaches ``parquet_part_bytes``, and at ``close``. The rows not yet written to the file count towards that size at their in-memory size, and are written as a row group once they reach a quarter of it, so parts and memory stay bounded whatever ``parquet_row_group_rows`` is. Serially, ``put`` then returns the size of the part it completed, or None. '''
+
+    FLUSH = object()
+
+    def __init__(self, destination, pipeline=False, queue_depth=2, compress_workers=1, upload_workers=2, sizer=None):
+        self.destination = destination
+        self.sizer = sizer
+        self.rolling_part_bytes = None
+        if hasattr(destination.encoder, 'open_writer'):
+            self.rolling_part_bytes = parse_bytes(destination.get_option('parquet_part_bytes'))
+        if self.rolling_part_bytes is not None and destination.streaming:
+            raise Exception("parquet_part_bytes can not be combined with streaming_upload")
+        self.rolling = None # (file, writer) of the open part
+        self.pipeline = None
+        if pipeline:
+            if destination.streaming:
+                stages = [ (self.stream, upload_workers) ]
+            else:
+                stages = [ (self.encode, 1),
+                           (self.compress, compress_workers),
+                           (self.upload, upload_workers) ]
+            self.pipeline = Pipeline(stages, queue_depth, destination.metrics)
+
+    def put(self, chunks):
+        if self.pipeline is not None:
+            self.pipeline.put(chunks)
+            return None
+        if self.destination.streaming:
+            return self.stream(chunks)
+        return self.upload(self.compress(self.encode(chunks)))
+
+    def encode(self, chunks):
+        if self.rolling_part_bytes is not None:
+            return self.roll(chunks)
+        return self.destination.encode_part(chunks), self.destination.reserve_batch_num(), sum(map(len, chunks))
+
+    def roll(self, chunks):
+        ''' Appends ``chunks`` to the open part. Returns the part once it is big enough, or on ``FLUSH``, and None otherwise. '''
+        destination = self.destination
+        if chunks is not self.FLUSH:
+            if self.rolling is None:
+                f = tempfile.NamedTemporaryFile('wb', delete=False)
+                self.rolling = (f, destination.encoder.open_writer(f, max(1, self.rolling_part_bytes // 4)))
+            f, writer = self.rolling
+            with destination.metrics.timer('encode'):
+                for rows in chunks:
+                    writer.write(destination.rows_to_columns(rows))
+            if f.tell() + writer.pending_bytes < self.rolling_part_bytes:
+                return None
+        elif self.rolling is None:
+            return None
+        f, writer = self.rolling
+        self.rolling = None
+        with destination.metrics.timer('encode'):
+            writer.close()
+            f.close()
+        destination.metrics.add('bytes_encoded', os.path.getsize(f.name))
+        return f.name, destination.reserve_batch_num(), writer.num_rows
+
+    def compress(self, part):
+        if part is None:
+            return None
+        filename, batch_num, num_rows = part
+        filename = self.destination.compress_data(filename, batch_num)
+        num_bytes = os.path.getsize(filename)
+        if self.sizer is not None:
+            self.sizer.record_part(num_rows, num_bytes)
+        return filename, batch_num, num_bytes
+
+    def upload(self, part):
+        if part is None:
+            return None
+        filename, batch_num, num_bytes = part
+        print(f"Uploading batch {batch_num} data from {filename} to {self.destination.uri}", file=sys.stderr)
+        self.destination.upload_data(filename, batch_num)
+        sys.stderr.flush()
+        return num_bytes
+
+    def stream(self, chunks):
+        num_bytes = self.destination.stream_part(chunks)
+        if self.sizer is not None:
+            self.sizer.record_part(sum(map(len, chunks)), num_bytes)
+        return num_bytes
+
+    def close(self):
+        if self.pipeline is not None:
+            try:
+                if self.rolling_part_bytes is not None:
+                    self.pipeline.put(self.FLUSH)
+            finally:
+                self.pipeline.join()
+        elif self.rolling_part_bytes is not None:
+            self.upload(self.compress(self.encode(self.FLUSH)))
+
+    def abort(self):
+        ''' Stops the pipeline without uploading the open part, ignoring errors, as the load has already failed. '''
+        if self.pipeline is not None:
+            self.pipeline.stop()
+        if self.rolling is not None:
+            f, writer = self.rolling
+            self.rolling = None
+            try:
+                f.close()
+            finally:
+                os.remove(f.name)
+
+class FanoutLoader(object):
+    ''' Sends the same parts to several ``PartLoader``'s, one per destination, so rows read once from the source reach all of them. Each loader encodes the part in its own destination's format, and the loaders' ``put`` run at the same time. ``put`` returns what the first loader returns. '''
+
+    def __init__(self, loaders):
+        self.loaders = loaders
+        self.pool = concurrent.futures.ThreadPoolExecutor(len(loaders))
+
+    def put(self, chunks):
+        futures = [ self.pool.submit(loader.put, chunks) for loader in self.loaders ]
+        return [ future.result() for future in futures ][0]
+
+    def close(self):
+        ''' Closes the loaders in order. After the first error, the remaining loaders are aborted and the error is re-raised. '''
+        error = None
+        try:
+            for loader in self.loaders:
+                if error is not None:
+                    loader.abort()
+                    continue
+                try:
+                    loader.close()
+                except BaseException as ex:
+                    error = ex
+        finally:
+            self.pool.shutdown()
+        if error is not None:
+            raise error
+
+    def abort(self):
+        self.pool.shutdown()
+        for loader in self.loaders:
+            loader.abort()
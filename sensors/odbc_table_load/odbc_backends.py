@@ -0,0 +1,124 @@
+''' Ways of running the main query of a period, selected with ``odbc_backend``.
+
+``pyodbc`` (the default) fetches rows. ``turbodbc`` and ``arrow_odbc`` bind result columns to buffers and fetch Arrow record batches, which the destinations encode a column at a time without going through Python values. Column metadata and the small queries (watermarks, partition bounds, fingerprints) always go through pyodbc.
+
+``connect`` makes a connection of the backend, which the sensor pools like its pyodbc connections and counts against ``max_source_connections``. ``query`` is a context manager running a query on such a connection and giving a cursor with ``description``, whose items start with the column name, and ``fetchmany``. Column-bound cursors return a whole record batch from ``fetchmany`` whatever the size asked for, and an empty list at the end.
+'''
+
+import sys, contextlib
+
+class ODBCBackend(object):
+
+    name = None
+    registered = {}
+    reuses_connections = True # whether idle connections are worth keeping in the pool
+
+    @classmethod
+    def register(cls):
+        cls.registered[cls.name] = cls
+
+    def __init__(self, sensor):
+        self.sensor = sensor
+
+    @property
+    def fetch_rows(self):
+        return max(1, self.sensor.batch_rows // 20)
+
+    def connect(self):
+        raise NotImplementedError()
+
+    def query(self, cnxn, sql, params):
+        ''' Runs ``sql`` on ``cnxn``, a connection made by ``connect``. '''
+        raise NotImplementedError()
+
+def get_backend(name, sensor):
+    try:
+        return ODBCBackend.registered[name](sensor)
+    except KeyError:
+        raise Exception(f"Unknown odbc_backend {name}. Only found {sorted(ODBCBackend.registered)}")
+
+class PyODBCBackend(ODBCBackend):
+    ''' Runs the query on a pyodbc connection, which can be the one the sensor uses for the other queries. '''
+
+    name = 'pyodbc'
+
+    def connect(self):
+        return self.sensor.connect()
+
+    @contextlib.contextmanager
+    def query(self, cnxn, sql, params):
+        cursor = cnxn.cursor()
+        try:
+            cursor.execute(sql, *params)
+            yield cursor
+        finally:
+            cursor.close()
+PyODBCBackend.register()
+
+class ArrowBatchCursor(object):
+    ''' The part of the cursor interface ``ODBCSensor.extract`` uses, over record batches. '''
+
+    def __init__(self, names, batches):
+        self.description = [ (name,) for name in names ]
+        self.batches = iter(batches)
+
+    def fetchmany(self, size):
+        for batch in self.batches:
+            if batch.num_rows:
+                return batch
+        return []
+
+class TurbodbcBackend(ODBCBackend):
+    ''' Fetches with turbodbc's ``fetcharrowbatches``, in buffers of ``batch_rows // 20`` rows. Needs turbodbc built with Arrow support. '''
+
+    name = 'turbodbc'
+
+    def connect(self):
+        import turbodbc
+        options = turbodbc.make_options(read_buffer_size=turbodbc.Rows(self.fetch_rows),
+                                        prefer_unicode=True, use_async_io=True)
+        return turbodbc.connect(connection_string=self.sensor.get_connection_string(), turbodbc_options=options)
+
+    @contextlib.contextmanager
+    def query(self, cnxn, sql, params):
+        cursor = cnxn.cursor()
+        try:
+            cursor.execute(sql, list(params))
+            names = [ d[0] for d in cursor.description ]
+            tables = cursor.fetcharrowbatches(strings_as_dictionary=False)
+            print("Fetching with turbodbc", file=sys.stderr)
+            yield ArrowBatchCursor(names, ( batch for table in tables for batch in table.to_batches() ))
+        finally:
+            cursor.close()
+TurbodbcBackend.register()
+
+class ArrowODBCBackend(ODBCBackend):
+    ''' Fetches with arrow-odbc's ``read_arrow_batches_from_odbc``, in batches of ``batch_rows // 20`` rows. Query parameters are passed as strings. The reader opens its own connection for each query, so pooled connections only stand for the right to open one. '''
+
+    name = 'arrow_odbc'
+    reuses_connections = False
+
+    def connect(self):
+        return ConnectionString(self.sensor.get_connection_string())
+
+    @contextlib.contextmanager
+    def query(self, cnxn, sql, params):
+        from arrow_odbc import read_arrow_batches_from_odbc
+        reader = read_arrow_batches_from_odbc(query=sql, connection_string=cnxn.connection_string,
+                                              batch_size=self.fetch_rows,
+                                              parameters=[ None if p is None else str(p) for p in params ])
+        if reader is None: # the statement returned no result set
+            yield ArrowBatchCursor([], [])
+            return
+        print("Fetching with arrow-odbc", file=sys.stderr)
+        yield ArrowBatchCursor(reader.schema.names, reader)
+ArrowODBCBackend.register()
+
+class ConnectionString(object):
+    ''' Stands for a connection of backends that connect for each query. '''
+
+    def __init__(self, connection_string):
+        self.connection_string = connection_string
+
+    def close(self):
+        pass
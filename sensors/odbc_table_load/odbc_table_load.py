@@ -47,7 +47,24 @@ This sensor will try to create a dataset for each period. The resulting dataset'
  * table
  * custom_sql
  * repository
+ * additional_uris
  * credentials.requested_name
+ * compression, output_format
+ * compression_level, compression_threads, parquet_compression, parquet_compression_level
+ * parquet_part_bytes, parquet_row_group_rows
+ * odbc_backend
+ * partition_column, num_partitions, partition_method
+ * pipeline, pipeline_queue_depth, compress_workers, upload_workers
+ * watermark_column, watermark_initial
+ * fingerprint_column, fingerprint_sql
+ * streaming_upload, streaming_buffer_bytes
+ * bigquery_write_mode, bigquery_staging_uri
+ * gs_composite_upload_threshold, gs_composite_upload_workers
+ * connection_pool_size, connection_max_idle_seconds, connection_health_check_sql
+ * target_part_bytes, max_fetch_bytes
+ * max_concurrent_periods, max_source_connections
+ * checkpoint, checkpoint_key_column
+ * metrics_textfile
 
 .. admonition:: Warning
     :class: warning
@@ -74,15 +91,26 @@ Supported repository classes as destination:
 
 1. ``s3``
 2. ``bigquery``
+3. ``gs``
+4. ``file`` (local or mounted directories, as ``file:///path/``)
 
 '''
 
 import argparse, os, sys
-import treldev, pyodbc, tempfile, json, datetime, subprocess
+import treldev, pyodbc, json, datetime, threading, concurrent.futures, contextlib, time, unittest, tempfile
 from os import listdir
 from os.path import isfile, join, isdir
 
-class ODBCSensor(treldev.ClockBasedSensor):
+try:
+    from destinations.backfill import ConcurrentBackfillMixin, Spool
+except ImportError: # running from the repository rather than with checked out files
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+    from destinations.backfill import ConcurrentBackfillMixin, Spool
+from destinations.fingerprint import FingerprintMixin, make_fingerprint
+from destinations import DestinationProtocol, PartLoader, PartSizer, FanoutLoader, parse_bytes
+from odbc_backends import get_backend, ODBCBackend, ArrowBatchCursor
+
+class ODBCSensor(FingerprintMixin, ConcurrentBackfillMixin, treldev.ClockBasedSensor):
 
     def __init__(self, config, credentials, *args, **kwargs):
         super().__init__(config, credentials, *args, **kwargs)
@@ -104,126 +132,188 @@ class ODBCSensor(treldev.ClockBasedSensor):
         self.database = self.config['database']
         self.table = self.config['table']
         self.custom_sql = self.config.get('custom_sql')
+        self.additional_uris = self.config.get('additional_uris') or []
+        self.odbc_backend = self.config.get('odbc_backend','pyodbc')
+        self.backend = get_backend(self.odbc_backend, self)
         self.batch_rows = self.config.get('batch_rows',100000)
         self.output_format = self.config.get('output_format','json')
+        assert self.output_format in ('json','parquet','avro'), f"Unknown output_format {self.output_format}"
         self.compression = self.config.get('compression','gz')
+        self.compression_level = self.config.get('compression_level')
+        self.compression_threads = self.config.get('compression_threads')
+        self.parquet_compression = self.config.get('parquet_compression','snappy')
+        self.parquet_compression_level = self.config.get('parquet_compression_level')
+        self.parquet_part_bytes = parse_bytes(self.config.get('parquet_part_bytes'))
+        self.parquet_row_group_rows = self.config.get('parquet_row_group_rows',1000000)
+        self.partition_column = self.config.get('partition_column')
+        self.num_partitions = self.config.get('num_partitions',1)
+        self.partition_method = self.config.get('partition_method','range')
+        assert self.partition_method in ('range','ntile'), f"Unknown partition_method {self.partition_method}"
+        self.pipeline = self.config.get('pipeline',False)
+        self.pipeline_queue_depth = self.config.get('pipeline_queue_depth',2)
+        self.compress_workers = self.config.get('compress_workers',1)
+        self.upload_workers = self.config.get('upload_workers',2)
+        self.streaming_upload = self.config.get('streaming_upload',False)
+        self.streaming_buffer_bytes = self.config.get('streaming_buffer_bytes',16*1024*1024)
+        assert self.streaming_buffer_bytes >= 5*1024*1024, "streaming_buffer_bytes must be at least 5MB, the S3 multipart minimum"
+        self.bigquery_write_mode = self.config.get('bigquery_write_mode','load')
+        assert self.bigquery_write_mode in ('load','storage_write'), f"Unknown bigquery_write_mode {self.bigquery_write_mode}"
+        self.bigquery_staging_uri = self.config.get('bigquery_staging_uri')
+        self.gs_composite_upload_threshold = self.config.get('gs_composite_upload_threshold','150MB')
+        self.gs_composite_upload_workers = self.config.get('gs_composite_upload_workers',8)
+        self.watermark_column = self.config.get('watermark_column')
+        self.watermark_initial = self.config.get('watermark_initial')
+        self.fingerprint_column = self.config.get('fingerprint_column')
+        self.fingerprint_sql = self.config.get('fingerprint_sql')
+        self.metrics_textfile = self.config.get('metrics_textfile')
+        self.target_part_bytes = parse_bytes(self.config.get('target_part_bytes'))
+        self.max_fetch_bytes = parse_bytes(self.config.get('max_fetch_bytes','64MB'))
+        connection_pool_size = self.config.get('connection_pool_size')
+        if connection_pool_size is None:
+            connection_pool_size = self.num_partitions + 1
+        max_source_connections = self.config.get('max_source_connections')
+        if max_source_connections is not None and max_source_connections < self.num_partitions + 1:
+            raise Exception("max_source_connections must be at least num_partitions + 1")
+        self.connection_pool = ConnectionPool(self.connect,
+                                              connection_pool_size,
+                                              self.config.get('connection_max_idle_seconds', 300),
+                                              self.config.get('connection_health_check_sql', 'select 1'),
+                                              max_source_connections)
+        # connections of other backends are pooled apart, within the same max_source_connections
+        self.query_pool = self.connection_pool
+        if self.odbc_backend != 'pyodbc':
+            self.query_pool = ConnectionPool(self.backend.connect,
+                                             connection_pool_size if self.backend.reuses_connections else 0,
+                                             self.config.get('connection_max_idle_seconds', 300),
+                                             self.config.get('connection_health_check_sql', 'select 1'),
+                                             shared_with=self.connection_pool)
+        self.column_cache = {}
+        self.init_concurrent_backfill()
+        if self.concurrent_backfill and self.watermark_column is not None:
+            raise Exception("max_concurrent_periods can not be used with watermark_column, as each period depends on the previous one")
+        if self.config.get('backfill_newest_first') and self.watermark_column is not None:
+            raise Exception("backfill_newest_first can not be used with watermark_column, as each period continues from the watermark of the one before it")
+        self.saved_watermark = None # (instance_ts, watermark) of the newest period loaded by this process
+        if self.fingerprint_column is not None or self.fingerprint_sql is not None:
+            if self.concurrent_backfill or self.watermark_column is not None:
+                raise Exception("fingerprint_column and fingerprint_sql can not be used with max_concurrent_periods or watermark_column")
+            if self.additional_uris:
+                raise Exception("fingerprint_column and fingerprint_sql can not be used with additional_uris")
+        self.checkpoint = self.config.get('checkpoint', False)
+        self.checkpoint_key_column = self.config.get('checkpoint_key_column')
+        if self.checkpoint and (self.pipeline or self.num_partitions > 1 or self.concurrent_backfill
+                                or self.bigquery_write_mode == 'storage_write' or self.bigquery_staging_uri is not None
+                                or self.parquet_part_bytes is not None or self.additional_uris
+                                or self.odbc_backend != 'pyodbc'):
+            raise Exception("checkpoint requires parts to be uploaded in order: pipeline false, num_partitions 1, "
+                            "max_concurrent_periods 1, bigquery_write_mode load, no bigquery_staging_uri, no parquet_part_bytes, "
+                            "no additional_uris and odbc_backend pyodbc")
+        self.progress = None
         self.known_contents = set([])
         self.cron_constraint = self.config['cron_constraint']
         self.lookback_seconds = self.config['max_instance_age_seconds'] - 1 # how far we should backfill missing datasets
         self.locking_seconds = self.config.get('locking_seconds',600)
     
+    def get_connection_string(self):
+        return 'DRIVER={'+self.driver+'};SERVER='+self.server+';DATABASE='+self.database+';UID='+self.username+';PWD='+ self.password
+
+    def connect(self):
+        return pyodbc.connect(self.get_connection_string())
+
+    def get_columns(self, cursor):
+        ''' Returns the table's column metadata, from the cache unless the column signature reported for an empty result has changed since it was cached. '''
+        cursor.execute(f"select * from {self.table} where 1=0")
+        signature = tuple( (d[0], str(d[1]), d[3], d[4], d[5], d[6]) for d in cursor.description )
+        cached = self.column_cache.get(self.table)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+        columns = list(cursor.columns(table=self.table))
+        self.column_cache[self.table] = (signature, columns)
+        return columns
+
     def save_data_to_path(self, load_info, uri, dataset=None, **kwargs):
         ''' if the previous call to get_new_datasetspecs returned a (load_info, datasetspec) tuple, then this call should save the data to the provided path, given the corresponding (load_info, path). '''
-        minute = load_info['instance_ts']
-
-        cnxn = pyodbc.connect('DRIVER={'+self.driver+'};SERVER='+self.server+';DATABASE='+self.database+';UID='+self.username+';PWD='+ self.password)
-        cursor = cnxn.cursor()
-
-        self.columns = list(cursor.columns(table=self.table))
-        
+        spool = self.get_spool(load_info) if self.concurrent_backfill else None
+        if spool is not None:
+            try:
+                self.load_spool(spool, load_info, uri)
+            finally:
+                spool.cleanup()
+            return
+        with self.connection_pool.connection() as cnxn:
+            self.load_period(cnxn, load_info, uri)
+
+    def get_sql(self, load_info, sql=None):
+        if sql is None:
+            sql = ("select * from {table}"
+                   if self.custom_sql is None
+                   else self.custom_sql)
+        return self.format_for_period(sql, load_info)
+
+    def format_for_period(self, template, load_info):
+        ''' Fills in ``custom_sql``, ``fingerprint_sql`` and ``additional_uris`` for the period. '''
+        args = {'table': self.table,
+                'instance_ts':load_info['instance_ts'],
+                'instance_ts_precision':self.instance_ts_precision,
+                'period_end': load_info['period_end']}
+        return template.format(**args)
+
+    def spool_period(self, load_info):
+        ''' Extracts the period into a local spool. Runs in the prefetch pool, so it must not touch per-load state such as ``self.columns``. '''
+        with self.connection_pool.connection() as cnxn:
+            cursor = cnxn.cursor()
+            columns = self.get_columns(cursor)
+            cursor.close()
+        sql = self.get_sql(load_info)
+        print("Prefetch SQL", sql, file=sys.stderr)
+        with self.query_pool.connection() as cnxn:
+            with self.backend.query(cnxn, sql, []) as results:
+                spool = Spool({'columns': columns, 'description': results.description})
+                try:
+                    while True:
+                        rows = results.fetchmany(self.batch_rows // 20)
+                        if not rows:
+                            break
+                        # record batches from column-bound backends are spooled as they are
+                        spool.write(rows if hasattr(rows, 'num_rows') else [ tuple(row) for row in rows ])
+                except BaseException:
+                    spool.cleanup()
+                    raise
+            spool.close()
+        print(f"Prefetched {spool.num_rows} rows for {load_info}", file=sys.stderr)
+        return spool
+
+    def load_spool(self, spool, load_info, uri):
+        self.columns = spool.info['columns']
+        destinations = self.get_destinations(uri, load_info)
+        self.extract(SpoolCursor(spool), destinations, uri)
+        for additional in destinations[1:]:
+            additional.finish()
+        destinations[0].finish()
+
+    def get_destinations(self, uri, load_info, checkpoint=None):
+        ''' Returns the destination of the dataset followed by those of ``additional_uris``, which receive the same rows. '''
+        destinations = ([ self.get_destination(uri, checkpoint) ]
+                        + [ self.get_destination(self.format_for_period(additional_uri, load_info))
+                            for additional_uri in self.additional_uris ])
+        for additional in destinations[1:]:
+            # finished before the first destination, which writes the metrics textfile for all of them
+            destinations[0].metrics.include(additional.metrics)
+        return destinations
+
+    def get_destination(self, uri, checkpoint=None):
         print(f"Table {uri} columns: ",file=sys.stderr)
         for col in self.columns:
             print(f"  {col}", file=sys.stderr)
         
         destination = DestinationProtocol.get_object_from_uri(uri, self)
+        destination.set_column_format(self.get_column_format(self.columns))
+        destination.checkpoint = checkpoint
         destination.prepare()
         print(f"Destination prepared", file=sys.stderr)
-            
-        fetch_rows = self.batch_rows // 20
-        sql = ("select * from {table}"
-               if self.custom_sql is None
-               else self.custom_sql)
-        args = {'table': self.table,
-                'instance_ts':minute,
-                'instance_ts_precision':self.instance_ts_precision,
-                'period_end': load_info['period_end']}
-        print("SQL", sql.format(**args), file=sys.stderr)
-        cursor.execute(sql.format(**args))
-
-        #print(f"Executed SQL:\n{cursor._last_executed}", file=sys.stderr)
-        done = False
-        while not done:
-            with tempfile.NamedTemporaryFile('w+', delete=False) as f:
-                for batch_i in range(20):
-                    done = True
-                    for row in cursor.fetchmany(fetch_rows):
-                        done = False
-                        destination.write_row_to_file(row, f)
-                    if done:
-                        break
-            print(f"Uploading batch {destination.get_next_batch_num()} data from {f.name} to {uri}",file=sys.stderr)
-            destination.append_data(f.name)
-            sys.stderr.flush()
-        destination.finish()
-
-class DestinationProtocol(object):
-
-    registered = {}
-    
-    @classmethod
-    def register(cls):
-        cls.registered[cls.protocol] = cls
-    
-    @classmethod
-    def get_class_from_protocol(cls, protocol):
-        try:
-            return cls.registered[protocol]
-        except KeyError:
-            logger.debug(f"{protocol} is not a registered destination protocol. Only found {cls.registered}")
-            raise
-        
-    @classmethod
-    def get_object_from_uri(cls, uri, sensor):
-        try:
-            uri_protocol,_ = uri.split(':',1)
-            return cls.registered[uri_protocol](uri, sensor)
-        except KeyError as ex:
-            msg = (f"{uri_protocol} is not a registered destination protocol. Only found {sorted(cls.registered)}")
-            sensor.logger.error(msg)
-            raise Exception(msg) from ex
-        
-    def __init__(self, uri, sensor):
-        self.uri = uri
-        self.sensor = sensor
-    
-    def prepare(self):
-        self.batch_num = 0
-        self.col_names = []
-        for col in self.sensor.columns:
-            self.col_names.append( col.column_name )
-        self.prepare_inner()
-
-    def append_data(self, file_name):
-        self.append_data_inner(file_name)
-        self.batch_num += 1
-
-    def finish(self):
-        self.finish_inner()
-
-    def write_row_to_file(self, row, f):
-        for i in range(len(row)):
-            if self.sensor.columns[i].data_type in (
-                    pyodbc.SQL_TYPE_DATE,
-                    pyodbc.SQL_TYPE_TIME,
-                    pyodbc.SQL_TYPE_TIMESTAMP,
-                    pyodbc.SQL_DECIMAL,
-                    pyodbc.SQL_NUMERIC,
-                    ):
-                if row[i] is not None:
-                    row[i] = str(row[i])
-            elif self.sensor.columns[i].data_type == pyodbc.SQL_BINARY:
-                if row[i] is not None:
-                    row[i] = base64.b64encode(row[i]).decode('utf-8')
-        json.dump(dict(filter((lambda x: x[1] is not None), zip(self.col_names, row))), f)
-        f.write('\n')
-    
-    def get_next_batch_num(self):
-        return self.batch_num
+        return destination
 
-class S3Destination(DestinationProtocol):
-
-    protocol = 's3'
-    parquet_type_mapping = {
+    column_types = {
         pyodbc.SQL_CHAR: 'string',
         pyodbc.SQL_VARCHAR: 'string',
         pyodbc.SQL_LONGVARCHAR: 'string',
@@ -231,191 +321,584 @@ class S3Destination(DestinationProtocol):
         pyodbc.SQL_WVARCHAR: 'string',
         pyodbc.SQL_WLONGVARCHAR: 'string',
         pyodbc.SQL_GUID: 'string',
-        pyodbc.SQL_TYPE_DATE: 'string',
-        pyodbc.SQL_TYPE_TIME: 'string',
-        pyodbc.SQL_TYPE_TIMESTAMP: 'string',
-        #pyodbc.SQL_TYPE_UTCDATETIME: 'DATETIME',
-        #pyodbc.SQL_TYPE_UTCTIME: 'DATETIME',
-        pyodbc.SQL_BINARY: 'binary',
-        pyodbc.SQL_VARBINARY: 'binary',
-        pyodbc.SQL_DECIMAL: 'string', #TODO
-        pyodbc.SQL_NUMERIC: 'string', #TODO
+        pyodbc.SQL_TYPE_DATE: 'date',
+        pyodbc.SQL_TYPE_TIME: 'time',
+        pyodbc.SQL_TYPE_TIMESTAMP: 'timestamp',
+        #pyodbc.SQL_TYPE_UTCDATETIME: 'timestamp',
+        #pyodbc.SQL_TYPE_UTCTIME: 'time',
+        pyodbc.SQL_BINARY: 'bytes',
+        pyodbc.SQL_VARBINARY: 'bytes',
+        pyodbc.SQL_DECIMAL: 'decimal',
+        pyodbc.SQL_NUMERIC: 'decimal',
         pyodbc.SQL_SMALLINT: 'int16',
         pyodbc.SQL_INTEGER: 'int32',
         pyodbc.SQL_BIT: 'int8', # test
         pyodbc.SQL_TINYINT: 'int8',
         pyodbc.SQL_BIGINT: 'int64',
-        pyodbc.SQL_REAL: 'float64',
-        pyodbc.SQL_FLOAT: 'float32',
+        pyodbc.SQL_REAL: 'float32',
+        pyodbc.SQL_FLOAT: 'float64',
         pyodbc.SQL_DOUBLE: 'float64',
-        pyodbc.SQL_INTERVAL_MONTH: 'string',
-        pyodbc.SQL_INTERVAL_YEAR: 'string',
-        pyodbc.SQL_INTERVAL_YEAR_TO_MONTH: 'string',
-        pyodbc.SQL_INTERVAL_DAY: 'string',
-        pyodbc.SQL_INTERVAL_HOUR: 'string',
-        pyodbc.SQL_INTERVAL_MINUTE: 'string',
-        pyodbc.SQL_INTERVAL_SECOND: 'string',
-        pyodbc.SQL_INTERVAL_DAY_TO_HOUR: 'string',
-        pyodbc.SQL_INTERVAL_DAY_TO_MINUTE: 'string',
-        pyodbc.SQL_INTERVAL_DAY_TO_SECOND: 'string',
-        pyodbc.SQL_INTERVAL_HOUR_TO_MINUTE: 'string',
-        pyodbc.SQL_INTERVAL_HOUR_TO_SECOND: 'string',
-        pyodbc.SQL_INTERVAL_MINUTE_TO_SECOND: 'string',
+        pyodbc.SQL_INTERVAL_MONTH: 'interval',
+        pyodbc.SQL_INTERVAL_YEAR: 'interval',
+        pyodbc.SQL_INTERVAL_YEAR_TO_MONTH: 'interval',
+        pyodbc.SQL_INTERVAL_DAY: 'interval',
+        pyodbc.SQL_INTERVAL_HOUR: 'interval',
+        pyodbc.SQL_INTERVAL_MINUTE: 'interval',
+        pyodbc.SQL_INTERVAL_SECOND: 'interval',
+        pyodbc.SQL_INTERVAL_DAY_TO_HOUR: 'interval',
+        pyodbc.SQL_INTERVAL_DAY_TO_MINUTE: 'interval',
+        pyodbc.SQL_INTERVAL_DAY_TO_SECOND: 'interval',
+        pyodbc.SQL_INTERVAL_HOUR_TO_MINUTE: 'interval',
+        pyodbc.SQL_INTERVAL_HOUR_TO_SECOND: 'interval',
+        pyodbc.SQL_INTERVAL_MINUTE_TO_SECOND: 'interval',
     }
-    
 
-    def prepare_inner(self):
-        self.s3_commands = treldev.S3Commands(credentials=self.sensor.credentials)
+    def get_column_format(self, columns):
+        ''' Describes the ODBC columns in the destinations' terms. '''
+        column_format = []
+        for col in columns:
+            if col.data_type not in self.column_types:
+                raise Exception(f"Column {col.column_name} has unsupported ODBC type {col.type_name} ({col.data_type})")
+            column_format.append({'name': col.column_name,
+                                  'type': self.column_types[col.data_type],
+                                  'nullable': bool(col.nullable),
+                                  'precision': col.column_size,
+                                  'scale': col.decimal_digits})
+        return column_format
+
+    def load_period(self, cnxn, load_info, uri):
+        minute = load_info['instance_ts']
+        cursor = cnxn.cursor()
 
-    
-    def append_data_inner(self, filename):
-        if self.sensor.compression == 'gz':
-            subprocess.check_call(f"gzip {filename}", shell=True)
-            filename = filename + '.gz'
-            file_uri = self.uri + f"part-{self.batch_num:>010}.gz"
-        if self.sensor.compression == 'parquet':
-            print("Detected parquet format", file=sys.stderr)
-            import pandas as pd
-            import pyarrow as pa
-            import pyarrow.parquet as pq
-
-            # Read JSON file into a pandas DataFrame
-            df = pd.read_json(filename, lines=True, dtype=False)
-
-            # Define the schema for the Parquet file
-            schema_fields = []
-            for column in self.sensor.columns:
-                t = self.parquet_type_mapping[column.data_type]
-                if t == 'timestamp(ms)':
-                    t = pa.timestamp('ms')
-                if t == 'date':
-                    t = pa.date32()
-                if t == 'decimal128':
-                    t = pa.decimal128(column[6],column[4])
-                print(f"Data types {column.column_name} {t}", file=sys.stderr)
-                
-                schema_fields.append(pa.field(column.column_name, t))
-                if column.column_name not in df:
-                    df[column.column_name] = None
-            schema = pa.schema(schema_fields)
-
-            # Convert the DataFrame to an Arrow Table with the specified schema
-            arrow_table = pa.Table.from_pandas(df, schema=schema)
-            os.remove(filename)
-
-            # Write the Arrow Table to a Parquet file
-            filename = f"{filename}.parquet"
-            pq.write_table(arrow_table, filename)
-            file_uri = self.uri + f"part-{self.batch_num:>010}.parquet"
+        self.columns = self.get_columns(cursor)
+            
+        sql = self.get_sql(load_info)
+        fingerprint = None
+        if self.fingerprint_column is not None or self.fingerprint_sql is not None:
+            fingerprint = self.get_fingerprint(cursor, load_info, sql)
+            if self.copy_if_unchanged(uri, minute, fingerprint):
+                cursor.close()
+                return
+        checkpoint = None
+        if self.checkpoint:
+            checkpoint = self.get_checkpoint(uri, sql)
+        query_sql = sql
+        sql_params = []
+        watermark_bounds = None
+        if self.watermark_column is not None:
+            # a resumed load keeps the range of the interrupted attempt, as the source may have grown since
+            sql, sql_params, watermark_bounds = self.apply_watermark(cursor, sql, minute,
+                                                                     None if checkpoint is None else checkpoint['watermark'])
+        if self.checkpoint:
+            self.progress = dict(checkpoint or {'sql': query_sql, 'watermark_column': self.watermark_column,
+                                                'watermark': watermark_bounds,
+                                                'key_column': self.checkpoint_key_column,
+                                                'parts': 0, 'rows': 0, 'bytes': 0, 'last_key': None})
+            sql, sql_params = self.apply_checkpoint(sql, sql_params, checkpoint)
+        destinations = self.get_destinations(uri, load_info, checkpoint)
+        destination = destinations[0]
+        print("SQL", sql, sql_params, file=sys.stderr)
+
+        if self.partition_column is None or self.num_partitions <= 1:
+            cursor.close()
+            with self.query_connection(cnxn) as query_cnxn, self.backend.query(query_cnxn, sql, sql_params) as results:
+                if checkpoint is not None and self.checkpoint_key_column is None:
+                    self.skip_rows(results, checkpoint['rows'])
+                self.extract(results, destinations, uri)
         else:
-            file_uri = self.uri + f"part-{self.batch_num:>010}"
-        print(f"final file uri {file_uri}", file=sys.stderr)
-        self.s3_commands.upload_file(filename, file_uri)
-        os.remove(filename)
+            bounds = self.get_partition_bounds(cursor, sql, sql_params)
+            cursor.close()
+            print(f"Extracting {len(bounds)+1} partitions on {self.partition_column} with bounds {bounds}", file=sys.stderr)
+            with concurrent.futures.ThreadPoolExecutor(len(bounds)+1) as pool:
+                futures = [ pool.submit(self.extract_partition, sql, sql_params, bounds, partition_i, destinations, uri)
+                            for partition_i in range(len(bounds)+1) ]
+                for future in futures:
+                    future.result()
+        if self.progress is not None:
+            destination.clear_checkpoint()
+            self.progress = None
+        if self.watermark_column is not None:
+            watermark = watermark_bounds[1]
+            destination.save_state({'watermark': watermark})
+            if self.saved_watermark is None or str(minute) > str(self.saved_watermark[0]):
+                self.saved_watermark = (minute, watermark)
+        if fingerprint is not None:
+            destination.save_state({'fingerprint': fingerprint})
+        for additional in destinations[1:]:
+            additional.finish()
+        destination.finish()
 
-    def finish_inner(self):
-        with tempfile.NamedTemporaryFile('w') as f:
-            self.s3_commands.upload_file(f.name, self.uri+'_SUCCESS')
-            f.close()
-S3Destination.register()
+    @contextlib.contextmanager
+    def query_connection(self, cnxn):
+        ''' Yields a connection of the backend for the main query. With pyodbc, that is ``cnxn``, which the other queries of the period used. '''
+        if self.query_pool is self.connection_pool:
+            yield cnxn
+            return
+        with self.query_pool.connection() as query_cnxn:
+            yield query_cnxn
+
+    def get_checkpoint(self, uri, sql):
+        ''' Returns the checkpoint left at ``uri`` by an interrupted attempt of the same query, or None. '''
+        checkpoint = DestinationProtocol.get_object_from_uri(uri, self).load_checkpoint()
+        if checkpoint is None:
+            return None
+        if (checkpoint.get('sql') != sql or checkpoint.get('watermark_column') != self.watermark_column
+            or checkpoint.get('key_column') != self.checkpoint_key_column):
+            print(f"Ignoring the checkpoint in {uri} as it was made for a different query", file=sys.stderr)
+            return None
+        print(f"Resuming {uri} after part {checkpoint['parts']-1}, {checkpoint['rows']} rows, "
+              f"{checkpoint['bytes']} bytes, last key {checkpoint['last_key']}", file=sys.stderr)
+        return checkpoint
+
+    def apply_checkpoint(self, sql, sql_params, checkpoint):
+        ''' With ``checkpoint_key_column``, orders ``sql`` by it and, when resuming, restricts it to the keys after the last committed part. '''
+        col = self.checkpoint_key_column
+        if col is None:
+            return sql, sql_params
+        if checkpoint is None or checkpoint['last_key'] is None:
+            return f"select * from ({sql}) _trel_ck order by {col}", sql_params
+        return f"select * from ({sql}) _trel_ck where {col} > ? order by {col}", sql_params + [checkpoint['last_key']]
+
+    def skip_rows(self, cursor, num_rows):
+        ''' Resuming without a key column: discards the rows that were already committed. Relies on the query returning rows in the same order. '''
+        print(f"Skipping {num_rows} rows already loaded", file=sys.stderr)
+        while num_rows > 0:
+            rows = cursor.fetchmany(min(num_rows, self.batch_rows))
+            if not rows:
+                break
+            num_rows -= len(rows)
+
+    def commit_checkpoint(self, destination, num_rows, num_bytes, last_key):
+        ''' Records a successfully uploaded part in the checkpoint manifest. '''
+        progress = self.progress
+        progress['parts'] = destination.get_next_batch_num()
+        progress['rows'] += num_rows
+        progress['bytes'] += num_bytes or 0
+        if last_key is not None:
+            progress['last_key'] = last_key
+        destination.save_checkpoint(progress)
+
+    def get_previous_watermark(self, instance_ts):
+        ''' Finds the watermark saved with the newest existing dataset older than ``instance_ts``. Falls back to ``watermark_initial``.
+
+        Periods loaded earlier by this process are not in ``existing_datasets``, which is read once per cycle, so the watermark this process saved last is used first. '''
+        if self.saved_watermark is not None and str(self.saved_watermark[0]) < str(instance_ts):
+            print(f"Found watermark {self.saved_watermark[1]} saved for {self.saved_watermark[0]}", file=sys.stderr)
+            return self.saved_watermark[1]
+        for uri, state in self.get_previous_states(instance_ts):
+            if 'watermark' in state:
+                print(f"Found watermark {state['watermark']} in {uri}", file=sys.stderr)
+                return state['watermark']
+        return self.watermark_initial
+
+    def get_fingerprint(self, cursor, load_info, sql):
+        ''' Summarizes the rows ``sql`` returns with ``fingerprint_sql`` or, with ``fingerprint_column``, with their count and the maximum of that column. The query, columns and output format are part of the fingerprint, so changing any of them reloads. '''
+        if self.fingerprint_sql is not None:
+            fingerprint_sql = self.get_sql(load_info, self.fingerprint_sql)
+        else:
+            fingerprint_sql = f"select count(*), max({self.fingerprint_column}) from ({sql}) _trel_fp"
+        print("Fingerprint SQL", fingerprint_sql, file=sys.stderr)
+        cursor.execute(fingerprint_sql)
+        values = list(cursor.fetchone())
+        print(f"Fingerprint values {values}", file=sys.stderr)
+        columns = [ (col.column_name, col.data_type, col.column_size, col.decimal_digits) for col in self.columns ]
+        return make_fingerprint(sql, columns, self.compression, self.output_format, values)
+
+    def apply_watermark(self, cursor, sql, instance_ts, bounds=None):
+        ''' Restricts ``sql`` to rows with ``watermark_column`` above the previous watermark and at most the current maximum, so consecutive periods get disjoint deltas even while the source is being written to. Returns the query, its parameters and the (low, high) bounds, which are taken as they are when given. '''
+        col = self.watermark_column
+        if bounds is not None:
+            low, high = bounds
+        else:
+            low = self.get_previous_watermark(instance_ts)
+            if low is None:
+                cursor.execute(f"select max({col}) from ({sql}) _trel_src")
+            else:
+                cursor.execute(f"select max({col}) from ({sql}) _trel_src where {col} > ?", low)
+            high = cursor.fetchone()[0]
+            if high is None: # nothing new, keep the previous watermark
+                high = low
+        print(f"Loading {col} in ({low}, {high}]", file=sys.stderr)
+        if low is None and high is None:
+            return sql, [], [low, high]
+        if low is None:
+            return f"select * from ({sql}) _trel_wm where {col} <= ?", [high], [low, high]
+        return f"select * from ({sql}) _trel_wm where {col} > ? and {col} <= ?", [low, high], [low, high]
+
+    def get_partition_bounds(self, cursor, sql, sql_params):
+        ''' Returns the sorted upper bounds of all partitions but the last. Partition i covers ``bounds[i-1] < partition_column <= bounds[i]``. '''
+        col = self.partition_column
+        n = self.num_partitions
+        if self.partition_method == 'ntile':
+            cursor.execute(f"select max({col}) from (select {col}, ntile({n}) over (order by {col}) as _trel_tile "
+                           f"from ({sql}) _trel_src where {col} is not null) _trel_tiles group by _trel_tile", *sql_params)
+            bounds = sorted(row[0] for row in cursor.fetchall())[:-1]
+        else:
+            cursor.execute(f"select min({col}), max({col}) from ({sql}) _trel_src", *sql_params)
+            lo, hi = cursor.fetchone()
+            if lo is None:
+                return []
+            if isinstance(lo, str):
+                raise Exception(f"partition_method range can not split string column {col}. Use partition_method: ntile")
+            if isinstance(lo, float):
+                bounds = [ lo + (hi - lo) * i / n for i in range(1, n) ]
+            else:
+                bounds = [ lo + (hi - lo) * i // n for i in range(1, n) ]
+        return sorted(set(bounds))
+
+    def extract_partition(self, sql, sql_params, bounds, partition_i, destinations, uri):
+        col = self.partition_column
+        clauses, params = [], []
+        if partition_i > 0:
+            clauses.append(f"{col} > ?")
+            params.append(bounds[partition_i-1])
+        if partition_i < len(bounds):
+            clauses.append(f"{col} <= ?")
+            params.append(bounds[partition_i])
+        where = ' and '.join(clauses)
+        if partition_i == 0 and clauses:
+            where = f"({where} or {col} is null)"
+        with self.query_pool.connection() as cnxn:
+            with self.backend.query(cnxn, f"select * from ({sql}) _trel_src" + (f" where {where}" if where else ""),
+                                    [*sql_params, *params]) as results:
+                self.extract(results, destinations, uri)
+        print(f"Partition {partition_i} done", file=sys.stderr)
+
+    def extract(self, cursor, destinations, uri):
+        ''' Drains an executed cursor into the destinations, one part per ``batch_rows`` rows, or per ``target_part_bytes`` when set. Part sizes, fetch metrics and checkpoints follow the first destination. '''
+        #print(f"Executed SQL:\n{cursor._last_executed}", file=sys.stderr)
+        destination = destinations[0]
+        result_col_names = [ d[0] for d in cursor.description ]
+        sizer = (PartSizer(self.target_part_bytes, self.max_fetch_bytes)
+                 if self.target_part_bytes is not None else None)
+        loaders = []
+        for i, each in enumerate(destinations):
+            each.set_result_columns(result_col_names)
+            loaders.append(PartLoader(each, self.pipeline, self.pipeline_queue_depth,
+                                      self.compress_workers, self.upload_workers, sizer if i == 0 else None))
+        loader = loaders[0] if len(loaders) == 1 else FanoutLoader(loaders)
+        key_index = None
+        if self.progress is not None and self.checkpoint_key_column is not None:
+            key_index = [ name.lower() for name in result_col_names ].index(self.checkpoint_key_column.lower())
+        try:
+            for chunks in self.fetch_parts(cursor, sizer, destination.metrics):
+                num_bytes = loader.put(chunks)
+                if self.progress is not None:
+                    last_key = chunks[-1][-1][key_index] if key_index is not None and chunks and chunks[-1] else None
+                    self.commit_checkpoint(destination, sum(map(len, chunks)), num_bytes, last_key)
+        except BaseException:
+            loader.abort()
+            raise
+        loader.close()
 
-            
-class BigQueryDestination(DestinationProtocol):
-
-    protocol = 'bq'
-    type_mapping = {
-        pyodbc.SQL_CHAR: 'STRING',
-        pyodbc.SQL_VARCHAR: 'STRING',
-        pyodbc.SQL_LONGVARCHAR: 'STRING',
-        pyodbc.SQL_WCHAR: 'STRING',
-        pyodbc.SQL_WVARCHAR: 'STRING',
-        pyodbc.SQL_WLONGVARCHAR: 'STRING',
-        pyodbc.SQL_GUID: 'STRING',
-        pyodbc.SQL_TYPE_DATE: 'DATE',
-        pyodbc.SQL_TYPE_TIME: 'TIME',
-        pyodbc.SQL_TYPE_TIMESTAMP: 'DATETIME',
-        #pyodbc.SQL_TYPE_UTCDATETIME: 'DATETIME',
-        #pyodbc.SQL_TYPE_UTCTIME: 'DATETIME',
-        pyodbc.SQL_BINARY: 'BYTES',
-        pyodbc.SQL_VARBINARY: 'BYTES',
-        pyodbc.SQL_DECIMAL: 'DECIMAL',
-        pyodbc.SQL_NUMERIC: 'DECIMAL',
-        pyodbc.SQL_SMALLINT: 'INTEGER',
-        pyodbc.SQL_INTEGER: 'INTEGER',
-        pyodbc.SQL_BIT: 'INTEGER', # test
-        pyodbc.SQL_TINYINT: 'INTEGER',
-        pyodbc.SQL_BIGINT: 'INTEGER',
-        pyodbc.SQL_REAL: 'FLOAT64',
-        pyodbc.SQL_FLOAT: 'FLOAT64',
-        pyodbc.SQL_DOUBLE: 'FLOAT64',
-        pyodbc.SQL_INTERVAL_MONTH: 'INTERVAL',
-        pyodbc.SQL_INTERVAL_YEAR: 'INTERVAL',
-        pyodbc.SQL_INTERVAL_YEAR_TO_MONTH: 'INTERVAL',
-        pyodbc.SQL_INTERVAL_DAY: 'INTERVAL',
-        pyodbc.SQL_INTERVAL_HOUR: 'INTERVAL',
-        pyodbc.SQL_INTERVAL_MINUTE: 'INTERVAL',
-        pyodbc.SQL_INTERVAL_SECOND: 'INTERVAL',
-        pyodbc.SQL_INTERVAL_DAY_TO_HOUR: 'INTERVAL',
-        pyodbc.SQL_INTERVAL_DAY_TO_MINUTE: 'INTERVAL',
-        pyodbc.SQL_INTERVAL_DAY_TO_SECOND: 'INTERVAL',
-        pyodbc.SQL_INTERVAL_HOUR_TO_MINUTE: 'INTERVAL',
-        pyodbc.SQL_INTERVAL_HOUR_TO_SECOND: 'INTERVAL',
-        pyodbc.SQL_INTERVAL_MINUTE_TO_SECOND: 'INTERVAL',
-    }
-    
-    def prepare_inner(self):
-        global bigquery, BigQuery, BigQueryURI, base64
+    def fetch_parts(self, cursor, sizer=None, metrics=None):
+        ''' Yields one list of ``fetchmany`` results per part. The first part is always yielded, even if empty. Without a sizer a part is 20 fetches of ``batch_rows // 20`` rows. '''
+        first = True
+        done = False
+        while not done:
+            chunks = []
+            part_rows = 0
+            while True:
+                start = time.perf_counter()
+                rows = cursor.fetchmany(self.batch_rows // 20 if sizer is None else sizer.get_fetch_rows(part_rows))
+                if metrics is not None:
+                    metrics.add('fetch_seconds', time.perf_counter() - start)
+                    metrics.add('rows_fetched', len(rows))
+                if not rows:
+                    done = True
+                    break
+                chunks.append(rows)
+                part_rows += len(rows)
+                if sizer is None:
+                    if len(chunks) == 20:
+                        break
+                else:
+                    sizer.record_fetch(rows)
+                    if part_rows >= sizer.get_part_rows():
+                        break
+            if chunks or first:
+                yield chunks
+            first = False
+
+class SpoolCursor(object):
+    ''' Replays a ``Spool`` written by ``ODBCSensor.spool_period`` through the part of the cursor interface that ``extract`` uses. '''
+
+    def __init__(self, spool):
+        self.description = spool.info['description']
+        self.chunks = spool.read()
+        self.buffer = []
+
+    def fetchmany(self, size):
+        while len(self.buffer) < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            if not isinstance(chunk, list):
+                return chunk # a record batch from a column-bound backend
+            self.buffer.extend(chunk)
+        rows, self.buffer = self.buffer[:size], self.buffer[size:]
+        return rows
+
+class ConnectionPool(object):
+    ''' Keeps up to ``max_size`` idle connections for reuse across periods. Connections idle for longer than ``max_idle_seconds`` are closed, and the rest are checked with ``health_check_sql`` before being handed out. At most ``max_connections`` connections are in use at once, if given, across this pool and those made ``shared_with`` it. '''
+
+    def __init__(self, connect, max_size, max_idle_seconds, health_check_sql, max_connections=None, shared_with=None):
+        self.connect = connect
+        self.max_size = max_size
+        self.max_idle_seconds = max_idle_seconds
+        self.health_check_sql = health_check_sql
+        self.idle = [] # (last used time, connection)
+        self.lock = threading.Lock()
+        if shared_with is not None: # connections of both pools count against the same limit
+            self.in_use = shared_with.in_use
+        else:
+            self.in_use = threading.BoundedSemaphore(max_connections) if max_connections else None
+
+    def get(self):
+        while True:
+            with self.lock:
+                self.evict()
+                if not self.idle:
+                    break
+                _, cnxn = self.idle.pop()
+            if self.is_healthy(cnxn):
+                return cnxn
+            self.close(cnxn)
+        return self.connect()
+
+    def put(self, cnxn):
+        with self.lock:
+            if len(self.idle) < self.max_size:
+                self.idle.append((time.time(), cnxn))
+                return
+        self.close(cnxn)
+
+    @contextlib.contextmanager
+    def connection(self):
+        ''' Yields a pooled connection. It goes back to the pool only if the block succeeds. '''
+        if self.in_use is not None:
+            self.in_use.acquire()
+        try:
+            cnxn = self.get()
+            try:
+                yield cnxn
+            except BaseException:
+                self.close(cnxn)
+                raise
+            self.put(cnxn)
+        finally:
+            if self.in_use is not None:
+                self.in_use.release()
+
+    def evict(self):
+        now = time.time()
+        expired = [ cnxn for last_used, cnxn in self.idle if now - last_used > self.max_idle_seconds ]
+        self.idle = [ (last_used, cnxn) for last_used, cnxn in self.idle if now - last_used <= self.max_idle_seconds ]
+        for cnxn in expired:
+            self.close(cnxn)
+
+    def is_healthy(self, cnxn):
+        try:
+            cursor = cnxn.cursor()
+            cursor.execute(self.health_check_sql).fetchall()
+            cursor.close()
+            return True
+        except Exception as ex:
+            print(f"Discarding pooled connection: {ex}", file=sys.stderr)
+            return False
+
+    def close(self, cnxn):
+        try:
+            cnxn.close()
+        except Exception:
+            pass
+
+class SQLiteConnection(object):
+    ''' The part of a pyodbc connection the sensor uses, over an SQLite database, for the tests. Every column is reported as an integer. '''
+
+    def __init__(self, path):
+        import sqlite3
+        self.cnxn = sqlite3.connect(path, check_same_thread=False)
+
+    def cursor(self):
+        return SQLiteCursor(self.cnxn.cursor())
+
+    def close(self):
+        self.cnxn.close()
+
+class SQLiteCursor(object):
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def execute(self, sql, *params):
+        self.cursor.execute(sql, params)
+        return self
+
+    @property
+    def description(self):
+        return self.cursor.description
+
+    def columns(self, table):
+        import types
+        return [ types.SimpleNamespace(column_name=name, data_type=pyodbc.SQL_BIGINT, type_name='integer',
+                                       column_size=19, decimal_digits=0, nullable=not notnull)
+                 for _, name, _, notnull, _, _ in self.cursor.execute(f"pragma table_info({table})").fetchall() ]
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+    def fetchmany(self, size):
+        return self.cursor.fetchmany(size)
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    def close(self):
+        self.cursor.close()
+
+class Test(unittest.TestCase):
+
+    def make_sensor(self, db_path, **config):
+        class SQLiteSensor(ODBCSensor):
+            connections = 0
+            def connect(self):
+                self.connections += 1
+                return SQLiteConnection(db_path)
+        config = dict({'instance_ts_precision': 'D', 'driver': 'sqlite', 'server': 'localhost', 'port': None,
+                       'username': '', 'password': '', 'database': 'test', 'table': 'source',
+                       'compression': None, 'cron_constraint': '0 0 * * *', 'max_instance_age_seconds': 86400*7},
+                      **config)
+        return SQLiteSensor(config, {}, None, [])
+
+    def read_rows(self, path):
+        rows = []
+        for name in sorted(os.listdir(path)):
+            if name.startswith('part-'):
+                with open(os.path.join(path, name)) as f:
+                    rows.extend( json.loads(line) for line in f )
+        return rows
+
+    def test_watermark_periods_in_one_cycle(self):
+        ''' Two periods loaded in the same cycle get disjoint deltas, although the second one is not in the datasets read at the start of the cycle. '''
+        import sqlite3
+        with tempfile.TemporaryDirectory() as root:
+            db_path = os.path.join(root, 'source.db')
+            db = sqlite3.connect(db_path)
+            db.execute("create table source (id integer, value integer)")
+            db.executemany("insert into source values (?, ?)", [ (i, i*2) for i in range(500) ])
+            db.commit()
+            sensor = self.make_sensor(db_path, watermark_column='id')
+            sensor.existing_datasets = []
+            sensor.save_data_to_path({'instance_ts': '2026-01-01 00:00:00', 'period_end': '2026-01-02 00:00:00'},
+                                     f"file://{root}/day1/")
+            db.executemany("insert into source values (?, ?)", [ (i, i*2) for i in range(500, 1000) ])
+            db.commit()
+            sensor.save_data_to_path({'instance_ts': '2026-01-02 00:00:00', 'period_end': '2026-01-03 00:00:00'},
+                                     f"file://{root}/day2/")
+            db.close()
+            self.assertEqual(sorted( row['id'] for row in self.read_rows(f"{root}/day1") ), list(range(500)))
+            self.assertEqual(sorted( row['id'] for row in self.read_rows(f"{root}/day2") ), list(range(500, 1000)))
+            with open(f"{root}/day2/_trel_state.json") as f:
+                self.assertEqual(json.load(f), {'watermark': 999})
+
+    def test_checkpoint_keeps_watermark_range(self):
+        ''' A load interrupted after some parts resumes within the watermark range it started with, although the source grew in between. '''
+        import sqlite3
+        with tempfile.TemporaryDirectory() as root:
+            db_path = os.path.join(root, 'source.db')
+            db = sqlite3.connect(db_path)
+            db.execute("create table source (id integer, value integer)")
+            db.executemany("insert into source values (?, ?)", [ (i, i*2) for i in range(1000) ])
+            db.commit()
+            load_info = {'instance_ts': '2026-01-01 00:00:00', 'period_end': '2026-01-02 00:00:00'}
+            config = {'watermark_column': 'id', 'checkpoint': True, 'checkpoint_key_column': 'id', 'batch_rows': 200}
+            sensor = self.make_sensor(db_path, **config)
+            sensor.existing_datasets = []
+            commit_checkpoint = sensor.commit_checkpoint
+            def interrupt_after_two_parts(destination, *args):
+                if destination.get_next_batch_num() > 2:
+                    raise KeyboardInterrupt()
+                commit_checkpoint(destination, *args)
+            sensor.commit_checkpoint = interrupt_after_two_parts
+            with self.assertRaises(KeyboardInterrupt):
+                sensor.save_data_to_path(load_info, f"file://{root}/day1/")
+            db.executemany("insert into source values (?, ?)", [ (i, i*2) for i in range(1000, 1100) ])
+            db.commit()
+            db.close()
+            sensor = self.make_sensor(db_path, **config)
+            sensor.existing_datasets = []
+            sensor.save_data_to_path(load_info, f"file://{root}/day1/")
+            self.assertEqual(sorted( row['id'] for row in self.read_rows(f"{root}/day1") ), list(range(1000)))
+            with open(f"{root}/day1/_trel_state.json") as f:
+                self.assertEqual(json.load(f), {'watermark': 999})
+
+    def test_arrow_backend_connections(self):
+        ''' A column-bound backend gets its connections from a pool of its own, counted against max_source_connections, and reused across periods. The pyodbc connection is only used for the other queries. '''
+        import sqlite3, pyarrow as pa
+        with tempfile.TemporaryDirectory() as root:
+            db_path = os.path.join(root, 'source.db')
+            db = sqlite3.connect(db_path)
+            db.execute("create table source (id integer, value integer)")
+            db.executemany("insert into source values (?, ?)", [ (i, i*2) for i in range(1000) ])
+            db.commit()
+            db.close()
+            connections = []
+            class SQLiteArrowBackend(ODBCBackend):
+                name = 'sqlite_arrow'
+                def connect(self):
+                    connections.append(SQLiteConnection(db_path))
+                    return connections[-1]
+                @contextlib.contextmanager
+                def query(self, cnxn, sql, params):
+                    cursor = cnxn.cursor().execute(sql, *params)
+                    names = [ d[0] for d in cursor.description ]
+                    rows = cursor.fetchall()
+                    yield ArrowBatchCursor(names, [ pa.record_batch([ pa.array(column, pa.int64()) for column in zip(*rows[i:i+self.fetch_rows]) ], names=names)
+                                                    for i in range(0, len(rows), self.fetch_rows) ])
+            SQLiteArrowBackend.register()
+            sensor = self.make_sensor(db_path, odbc_backend='sqlite_arrow', partition_column='id', num_partitions=3,
+                                      max_source_connections=4, batch_rows=200)
+            for day in (1, 2):
+                sensor.save_data_to_path({'instance_ts': f"2026-01-0{day} 00:00:00", 'period_end': f"2026-01-0{day+1} 00:00:00"},
+                                         f"file://{root}/day{day}/")
+                self.assertEqual(sorted( row['id'] for row in self.read_rows(f"{root}/day{day}") ), list(range(1000)))
+            self.assertEqual(sensor.connections, 1)
+            self.assertLessEqual(len(connections), 3) # one per partition at most, not per partition and period
+            self.assertEqual(sensor.query_pool.in_use, sensor.connection_pool.in_use)
+            for _ in range(4): # every connection was given back
+                self.assertTrue(sensor.connection_pool.in_use.acquire(blocking=False))
+
+    def test_concurrent_backfill_spools_following_periods(self):
+        ''' With max_concurrent_periods, the period being saved is loaded from the source and only the ones after it are spooled. '''
+        import sqlite3
+        with tempfile.TemporaryDirectory() as root:
+            db_path = os.path.join(root, 'source.db')
+            db = sqlite3.connect(db_path)
+            db.execute("create table source (id integer, value integer)")
+            db.executemany("insert into source values (?, ?)", [ (i, i*2) for i in range(1000) ])
+            db.commit()
+            db.close()
+            sensor = self.make_sensor(db_path, max_concurrent_periods=2)
+            spooled = []
+            spool_period = sensor.spool_period
+            def record_spool(load_info):
+                spooled.append(load_info['instance_ts'])
+                return spool_period(load_info)
+            sensor.spool_period = record_spool
+            load_infos = [ {'instance_ts': f"2026-01-0{day} 00:00:00", 'period_end': f"2026-01-0{day+1} 00:00:00"}
+                           for day in (1, 2) ]
+            sensor.pending_load_infos = load_infos
+            for day, load_info in zip((1, 2), load_infos):
+                sensor.save_data_to_path(load_info, f"file://{root}/day{day}/")
+                self.assertEqual(sorted( row['id'] for row in self.read_rows(f"{root}/day{day}") ), list(range(1000)))
+            self.assertEqual(spooled, ['2026-01-02 00:00:00'])
+            sensor.prefetch_pool.shutdown()
+
+    def test_watermark_rejects_newest_first(self):
+        with self.assertRaises(Exception):
+            self.make_sensor(':memory:', watermark_column='id', backfill_newest_first=True)
 
-        assert self.sensor.output_format == 'json'
-        
-        from treldev.gcputils import BigQuery, BigQueryURI
-        import treldev.gcputils
-        from google.cloud import bigquery
-        import base64
-
-        print("Getting Bigquery client", file=sys.stderr)
-        self.client = treldev.gcputils.BigQuery.get_client()
-        print("Got BigQuery client", file=sys.stderr)
-        for col in self.sensor.columns:
-            bq_type = self.type_mapping[col.data_type]
-            print(f"{col.column_name}:{bq_type},", file=sys.stderr,end='')
-        print("", file=sys.stderr)
-
-        self.schema = []
-        self.bquri = BigQueryURI(self.uri)
-        for col in self.sensor.columns:
-            bq_type = self.type_mapping[col.data_type]
-            self.schema.append( bigquery.SchemaField(col.column_name, bq_type, mode=("NULLABLE" if col.nullable else "REQUIRED")) )
-        self.client.delete_table(self.bquri.path, not_found_ok=True)
-        table = bigquery.Table(self.bquri.path, schema=self.schema)
-        
-        table = self.client.create_table(table)
-        print("Created table {}.{}.{}".format(table.project, table.dataset_id, table.table_id), file=sys.stderr)
-        
-    def write_row_to_file(self, row, f):
-        for i in range(len(row)):
-            bq_type = self.type_mapping[self.sensor.columns[i].data_type]
-            if bq_type in ('DATE','TIME','DATETIME','INTERVAL'):
-                if row[i] is not None:
-                    row[i] = str(row[i])
-            elif bq_type == 'BYTES':
-                if row[i] is not None:
-                    row[i] = base64.b64encode(row[i]).decode('utf-8')
-        json.dump(dict(filter((lambda x: x[1] is not None), zip(self.col_names, row))), f)
-        f.write('\n')
-    
-    def append_data_inner(self, filename):
-        loadjob_config_dict = {
-            'write_disposition': bigquery.WriteDisposition.WRITE_APPEND,
-            'source_format': bigquery.SourceFormat.NEWLINE_DELIMITED_JSON,
-            }
-        self.bquri.load_file(filename, loadjob_config_dict)
-        os.remove(filename)
-        
-    def finish_inner(self):
-        pass
-BigQueryDestination.register()
-        
 if __name__ == '__main__':
     treldev.Sensor.init_and_run(ODBCSensor)
     
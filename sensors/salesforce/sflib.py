@@ -5,11 +5,11 @@ try:
 except: 
     pass # for unit tests. They will import destinations another way.
 
-import unittest, yaml, json, os, os.path, tempfile, sys
+import unittest, yaml, json, os, os.path, tempfile, sys, time, itertools, csv, io, queue, threading, weakref
 
-column_type_map = {
-    'bq': yaml.safe_load('''
-boolean: boolean #3103 indicates how many entries existed in the default db with this column type
+# Salesforce field types and the column types the destinations use for them. Other types are loaded as strings.
+column_types = yaml.safe_load('''
+boolean: bool #3103 indicates how many entries existed in the default db with this column type
 reference: string #3062
 string: string #2651
 datetime: string #2497
@@ -34,8 +34,7 @@ combobox: string #8
 multipicklist: string #5
 encryptedstring: string #4
 long: int64 # 2
-'''),
-                   }
+''')
 
 def instantiate_from_creds(creds):
     sfcreds = json.loads(creds)
@@ -73,9 +72,155 @@ def get_data_iterable(sf, table_data, cols = None):
 class TableNotQueryableException(Exception):
     pass
 
-def load_table(sf, table_name, uri, sensor, cols=None):
+class BulkQueryFailedException(Exception):
+    pass
+
+# field types that Bulk API queries can not return
+bulk_unsupported_types = {'address', 'location', 'base64'}
+
+# how values of the other types are parsed from the CSV results, like the REST API returns them
+bulk_converters = {
+    'bool': {'true': True, 'false': False}.get,
+    'int64': lambda v: int(v) if v.lstrip('-').isdigit() else int(float(v)),
+    'float64': float,
+}
+
+# fields whose Bulk values are written differently by the REST API, by Salesforce field type
+bulk_field_converters = {
+    # 2024-01-01T00:00:00.000Z as 2024-01-01T00:00:00.000+0000
+    'datetime': lambda v: v[:-1] + '+0000' if v.endswith('Z') else v,
+}
+
+def delete_bulk_job(sf, job_url):
+    try:
+        sf.session.delete(job_url, headers=sf.headers)
+    except Exception as ex:
+        print(f"Unable to delete bulk query job {job_url}: {ex}", file=sys.stderr)
+
+def start_bulk_query(sf, soql, poll_seconds=5):
+    ''' Submits a Bulk API 2.0 query job and waits for it to complete. Returns the job's URL. '''
+    jobs_url = f"{sf.base_url}jobs/query"
+    response = sf.session.post(jobs_url, headers=sf.headers, json={'operation': 'query', 'query': soql})
+    if response.status_code >= 400:
+        raise BulkQueryFailedException(response.text)
+    job_url = f"{jobs_url}/{response.json()['id']}"
+    try:
+        while True:
+            response = sf.session.get(job_url, headers=sf.headers)
+            response.raise_for_status()
+            job = response.json()
+            if job['state'] == 'JobComplete':
+                print(f"Bulk query job {job['id']} completed with {job.get('numberRecordsProcessed')} records", file=sys.stderr)
+                return job_url
+            if job['state'] in ('Failed', 'Aborted'):
+                raise BulkQueryFailedException(job.get('errorMessage') or job['state'])
+            time.sleep(poll_seconds)
+    except BaseException:
+        delete_bulk_job(sf, job_url)
+        raise
+
+def get_bulk_result_pages(sf, job_url, page_records):
+    ''' Yields the CSV results of a completed job, ``page_records`` records at a time, then deletes the job. '''
+    try:
+        locator = None
+        while True:
+            params = {'maxRecords': page_records}
+            if locator is not None:
+                params['locator'] = locator
+            response = sf.session.get(f"{job_url}/results", headers=dict(sf.headers, Accept='text/csv'), params=params)
+            response.raise_for_status()
+            yield response.content.decode('utf-8')
+            locator = response.headers.get('Sforce-Locator')
+            if not locator or locator == 'null':
+                return
+    finally:
+        delete_bulk_job(sf, job_url)
+
+def prefetched(iterable, depth):
+    ''' Iterates over ``iterable`` in a background thread, running up to ``depth`` items ahead. When the consumer stops early, the thread stops too and closes ``iterable``, e.g. so that a generator can clean up in its ``finally``. '''
+    items = queue.Queue(depth)
+    done = object()
+    stop = threading.Event()
+    def put(entry):
+        while not stop.is_set():
+            try:
+                items.put(entry, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+    def run():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    break
+            else:
+                put((done, None))
+        except BaseException as ex:
+            put((done, ex))
+        finally:
+            if hasattr(iterable, 'close'):
+                iterable.close()
+    threading.Thread(target=run, daemon=True).start()
+    try:
+        while True:
+            item, error = items.get()
+            if item is done:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
+
+def get_bulk_data_iterable(sf, table_data, cols, table_cols, sensor=None):
+    ''' Runs the query as a Bulk API 2.0 job. The returned iterator yields the records as tuples in the order of ``cols``, with empty values as None and values as the REST API gives them, while the next result pages download in the background. The job is deleted once the iterator is exhausted or closed, or when it is discarded without being iterated. '''
+    job_url = start_bulk_query(sf, f"select {', '.join(cols)} from {table_data['name']}",
+                               getattr(sensor, 'bulk_poll_seconds', 5))
+    pages = prefetched(get_bulk_result_pages(sf, job_url, getattr(sensor, 'bulk_page_records', 100000)),
+                       getattr(sensor, 'bulk_prefetch_pages', 2))
+    converters = [ bulk_field_converters.get(table_cols[col]) or bulk_converters.get(column_types.get(table_cols[col], 'string'))
+                   for col in cols ]
+    def records():
+        unstarted.detach() # from here on, the downloads delete the job
+        try:
+            for page in pages:
+                reader = csv.reader(io.StringIO(page, newline=''))
+                header = next(reader, None)
+                if header is None:
+                    continue
+                if header != cols:
+                    raise Exception(f"Bulk query returned the columns {header} instead of {cols}")
+                columns = list(zip(*reader))
+                columns = [ [ None if v == '' else (v if converter is None else converter(v)) for v in values ]
+                            for values, converter in zip(columns, converters) ]
+                yield from zip(*columns)
+        finally:
+            pages.close() # stops the downloads, which deletes the job
+    it = records()
+    unstarted = weakref.finalize(it, delete_bulk_job, sf, job_url)
+    return it
+
+def get_table_fingerprint(sf, table_name, cols=None):
+    ''' Returns a cheap summary of the table's contents: its columns, the record count and the latest SystemModstamp. Returns None for tables without SystemModstamp. '''
+    table_data = get_table(sf, table_name)
+    if not table_data['queryable']:
+        raise TableNotQueryableException(f"Specified table {table_name} is not queryable.")
+    table_cols = extract_table_columns(table_data)
+    if 'SystemModstamp' not in dict(table_cols):
+        return None
+    record = sf.query(f"select count(Id) total, max(SystemModstamp) last_modified from {table_name}")['records'][0]
+    return [table_cols, cols, record['total'], record['last_modified']]
+
+def load_table(sf, table_name, uri, sensor, cols=None, state=None):
     ''' Copies the given table from the given salesforce instance to the provided URI using destination classes'''
-    
+    table_cols, extraction_columns, data_it = start_table_extraction(sf, table_name, cols, sensor)
+    write_table(table_cols, extraction_columns, data_it, uri, sensor, state)
+
+def start_table_extraction(sf, table_name, cols=None, sensor=None):
+    ''' Checks the table and columns and starts the query. Returns the table's column types, the columns being extracted and an iterator over the records.
+
+    With the sensor's ``extraction_api`` set to bulk, the query runs as a Bulk API 2.0 job and the records are tuples in the order of the columns. Tables with fields Bulk API can not return, and queries Salesforce refuses to run that way, go through the REST API, whose records are dicts. '''
     table_data = get_table(sf, table_name)
     if not table_data['queryable']:
         raise TableNotQueryableException(f"Specified table {table_name} is not queryable.")
@@ -85,44 +230,54 @@ def load_table(sf, table_name, uri, sensor, cols=None):
             raise Exception(f"The columns {set(cols).difference(table_cols)} that you requested do not existing in table {table_name}")
     extraction_columns = list(table_cols) if cols is None else cols
 
+    if getattr(sensor, 'extraction_api', 'rest') == 'bulk':
+        unsupported = [ col for col in extraction_columns if table_cols[col] in bulk_unsupported_types ]
+        if unsupported:
+            print(f"Using the REST API for {table_name}, as Bulk API can not return {unsupported}", file=sys.stderr)
+        else:
+            try:
+                return table_cols, extraction_columns, get_bulk_data_iterable(sf, table_data, extraction_columns,
+                                                                              table_cols, sensor)
+            except BulkQueryFailedException as ex:
+                print(f"Bulk query of {table_name} failed, using the REST API: {ex}", file=sys.stderr)
+
     data_it = get_data_iterable(sf, table_data, extraction_columns)
-    destination = destinations.DestinationProtocol.get_object_from_uri(uri, sensor)
-    if destination.get_schema_format_name() in column_type_map:
-        destination_type_map = column_type_map[destination.get_schema_format_name()]
-        destination_schema = []
-        for column in extraction_columns:
-            type_ = table_cols[column]
-            column_destination_type = destination_type_map[type_]
-            destination_schema.append({'name': column,
-                                       'type': column_destination_type,
-                                       'nullable': True})
-        destination.set_column_format(destination_schema)
-    else:
-        if destination.requires_column_schema:
-            raise Exception("Destination requires column schema, but none provided.")
+    return table_cols, extraction_columns, data_it
 
+def write_table(table_cols, extraction_columns, data_it, uri, sensor, state=None):
+    ''' Writes the records from ``data_it`` to the provided URI using destination classes. ``state`` is saved with the dataset. '''
+    destination = destinations.DestinationProtocol.get_object_from_uri(uri, sensor)
+    destination.set_column_format([ {'name': column,
+                                      'type': column_types.get(table_cols[column], 'string'),
+                                      'nullable': True}
+                                     for column in extraction_columns ])
     destination.prepare()
 
-    #print(f"Executed SQL:\n{cursor._last_executed}", file=sys.stderr)
-    fetch_rows = 100000 # batch size
-    done = False
-    while not done:
-        with tempfile.NamedTemporaryFile('w+', delete=False) as f:
-            row_i = 0
-            done = True
-            for row in data_it:
-                done = False
-                del row['attributes']
-                #print(row)
-                destination.write_dict_row_to_file(row, f)
-                row_i += 1
-                if row_i >= fetch_rows:
-                    break
-            if done:
+    loader = destinations.PartLoader(destination,
+                                     getattr(sensor, 'pipeline', False),
+                                     getattr(sensor, 'pipeline_queue_depth', 2),
+                                     getattr(sensor, 'compress_workers', 1),
+                                     getattr(sensor, 'upload_workers', 2))
+    batch_rows = getattr(sensor, 'batch_rows', 100000)
+    data_it = iter(data_it)
+    try:
+        while True:
+            fetch_start = time.perf_counter()
+            records = list(itertools.islice(data_it, batch_rows))
+            destination.metrics.add('fetch_seconds', time.perf_counter() - fetch_start)
+            destination.metrics.add('rows_fetched', len(records))
+            if not records:
                 break
-        print(f"Uploading batch {destination.get_next_batch_num()} data from {f.name} to {uri}",file=sys.stderr)
-        destination.append_data(f.name)
-        sys.stderr.flush()
+            # REST records are dicts keyed by field name, so the 'attributes' entry is simply not looked up.
+            # Bulk records are tuples in the order of the columns.
+            loader.put([records])
+            sys.stderr.flush()
+    except BaseException:
+        loader.abort()
+        raise
+    loader.close()
+    if state is not None:
+        destination.save_state(state)
     destination.finish()
     
 
@@ -156,6 +311,66 @@ class Test(unittest.TestCase):
         print("not_queryable - failed", not_queryable.difference(failed))
 
     
+    def test_prefetched_stops_early(self):
+        ''' A consumer that stops early stops the prefetching thread, which closes the source so that its cleanup runs. '''
+        closed = threading.Event()
+        def pages():
+            try:
+                for i in itertools.count():
+                    yield i
+            finally:
+                closed.set()
+        items = prefetched(pages(), 2)
+        self.assertEqual([ next(items) for _ in range(3) ], [0, 1, 2])
+        items.close()
+        self.assertTrue(closed.wait(5))
+        self.assertEqual(list(prefetched(iter(range(5)), 2)), list(range(5)))
+        def failing():
+            yield 1
+            raise ValueError()
+        with self.assertRaises(ValueError):
+            list(prefetched(failing(), 2))
+
+    def test_bulk_job_deleted(self):
+        ''' The job is deleted when the query fails while polling, and when the records are never iterated. '''
+        import gc
+        from types import SimpleNamespace
+        class Response(object):
+            def __init__(self, body):
+                self.body, self.status_code, self.text, self.headers = body, 200, '', {}
+                self.content = body.encode('utf-8') if isinstance(body, str) else b''
+            def json(self):
+                return self.body
+            def raise_for_status(self):
+                pass
+        class Session(object):
+            def __init__(self, states):
+                self.states, self.deleted = states, []
+            def post(self, url, **kwargs):
+                return Response({'id': 'job1'})
+            def get(self, url, **kwargs):
+                if url.endswith('/results'):
+                    return Response('Id,CreatedDate\n1,2024-01-01T00:00:00.000Z\n')
+                return Response({'id': 'job1', 'state': self.states.pop(0)})
+            def delete(self, url, **kwargs):
+                self.deleted.append(url)
+        def make_sf(states):
+            return type('SF', (), {'base_url': 'https://sf/', 'headers': {}, 'session': Session(states)})()
+        table_data, cols, table_cols = {'name': 'Account'}, ['Id', 'CreatedDate'], {'Id': 'id', 'CreatedDate': 'datetime'}
+        sf = make_sf(['InProgress', 'Failed'])
+        with self.assertRaises(BulkQueryFailedException):
+            get_bulk_data_iterable(sf, table_data, cols, table_cols, SimpleNamespace(bulk_poll_seconds=0))
+        self.assertEqual(sf.session.deleted, ['https://sf/jobs/query/job1'])
+        sf = make_sf(['JobComplete'])
+        records = get_bulk_data_iterable(sf, table_data, cols, table_cols)
+        del records
+        gc.collect()
+        self.assertEqual(sf.session.deleted, ['https://sf/jobs/query/job1'])
+        sf = make_sf(['JobComplete'])
+        self.assertEqual(list(get_bulk_data_iterable(sf, table_data, cols, table_cols)),
+                         [('1', '2024-01-01T00:00:00.000+0000')])
+        self.assertEqual(sf.session.deleted, ['https://sf/jobs/query/job1'])
+
     def test(self):
         import yaml, os
         with open(os.path.expanduser('~/.trel_test_credentials.yml')) as f:
@@ -11,7 +11,10 @@ The behavior is as follows:
 
 Supported repository classes as destination:
 
-1. ``bigquery``
+1. ``s3``
+2. ``bigquery``
+3. ``gs``
+4. ``file`` (local or mounted directories, as ``file:///path/``)
 
 '''
 
@@ -20,8 +23,10 @@ import treldev, tempfile, json, datetime, subprocess, traceback
 from os import listdir
 from os.path import isfile, join, isdir
 import sflib
+from destinations.backfill import ConcurrentBackfillMixin, Spool
+from destinations.fingerprint import FingerprintMixin, make_fingerprint
 
-class SalesforceSensor(treldev.ClockBasedSensor):
+class SalesforceSensor(FingerprintMixin, ConcurrentBackfillMixin, treldev.ClockBasedSensor):
     
     def __init__(self, config, credentials, *args, **kwargs):
         super().__init__(config, credentials, *args, **kwargs)
@@ -37,11 +42,41 @@ class SalesforceSensor(treldev.ClockBasedSensor):
         self.ignore_recommended_excluded_tables = self.config.get('ignore_recommended_excluded_tables', False)
         self.table_details = self.config.get('table_details',{})
         self.batch_rows = self.config.get('batch_rows',100000)
+        self.compression = self.config.get('compression','gz')
+        self.output_format = self.config.get('output_format','json')
+        assert self.output_format in ('json','parquet','avro'), f"Unknown output_format {self.output_format}"
+        self.compression_level = self.config.get('compression_level')
+        self.compression_threads = self.config.get('compression_threads')
+        self.parquet_compression = self.config.get('parquet_compression','snappy')
+        self.parquet_compression_level = self.config.get('parquet_compression_level')
+        self.parquet_part_bytes = self.config.get('parquet_part_bytes')
+        self.parquet_row_group_rows = self.config.get('parquet_row_group_rows',1000000)
+        self.pipeline = self.config.get('pipeline',False)
+        self.pipeline_queue_depth = self.config.get('pipeline_queue_depth',2)
+        self.compress_workers = self.config.get('compress_workers',1)
+        self.upload_workers = self.config.get('upload_workers',2)
+        self.streaming_upload = self.config.get('streaming_upload',False)
+        self.streaming_buffer_bytes = self.config.get('streaming_buffer_bytes',16*1024*1024)
+        assert self.streaming_buffer_bytes >= 5*1024*1024, "streaming_buffer_bytes must be at least 5MB, the S3 multipart minimum"
+        self.bigquery_write_mode = self.config.get('bigquery_write_mode','load')
+        self.bigquery_staging_uri = self.config.get('bigquery_staging_uri')
+        self.gs_composite_upload_threshold = self.config.get('gs_composite_upload_threshold','150MB')
+        self.gs_composite_upload_workers = self.config.get('gs_composite_upload_workers',8)
+        self.metrics_textfile = self.config.get('metrics_textfile')
+        self.fingerprint = self.config.get('fingerprint',False)
+        self.extraction_api = self.config.get('extraction_api','rest')
+        assert self.extraction_api in ('rest','bulk'), f"Unknown extraction_api {self.extraction_api}"
+        self.bulk_page_records = self.config.get('bulk_page_records',100000)
+        self.bulk_poll_seconds = self.config.get('bulk_poll_seconds',5)
+        self.bulk_prefetch_pages = self.config.get('bulk_prefetch_pages',2)
         self.known_contents = set([])
         self.cron_constraint = self.config['cron_constraint']
         self.lookback_seconds = self.config['max_instance_age_seconds'] - 1 # how far we should backfill missing datasets
         self.locking_seconds = self.config.get('locking_seconds',3600)
         self.mandatory_load_tables = self.config.get('mandatory_load_tables',[])
+        self.init_concurrent_backfill()
+        if self.fingerprint and self.concurrent_backfill:
+            raise Exception("fingerprint can not be used with max_concurrent_periods above 1")
 
     def get_dataset_classes(self, load_info):
         sf = sflib.instantiate_from_creds(self.credentials_str)
@@ -57,22 +92,66 @@ class SalesforceSensor(treldev.ClockBasedSensor):
             load_info_copy['table_name'] = table_name
             yield self.dataset_class_prefix+table_name, load_info_copy
         
-    def save_data_to_path(self, load_info, uri, dataset=None, **kwargs):
+    def spool_period(self, load_info):
+        ''' Extracts the table for this period into a local spool. Runs in the prefetch pool. '''
         sf = sflib.instantiate_from_creds(self.credentials_str)
+        table_name = load_info['table_name']
+        try:
+            table_cols, extraction_columns, data_it = sflib.start_table_extraction(
+                sf, table_name, cols=self.table_details.get(table_name,{}).get('columns'), sensor=self)
+            spool = Spool({'table_cols': table_cols, 'extraction_columns': extraction_columns})
+            try:
+                chunk = []
+                for row in data_it:
+                    chunk.append(row)
+                    if len(chunk) >= self.batch_rows:
+                        spool.write(chunk)
+                        chunk = []
+                spool.write(chunk)
+            except BaseException:
+                spool.cleanup()
+                raise
+            spool.close()
+        finally:
+            sf.session.close()
+        print(f"Prefetched {spool.num_rows} rows of {table_name}", file=sys.stderr)
+        return spool
+
+    def save_data_to_path(self, load_info, uri, dataset=None, **kwargs):
         table_name = load_info['table_name']
         print("processing table", load_info['table_name'], file=sys.stderr)
         non_queryable = False
         failed = False
         try:
-            sflib.load_table(sf, table_name, uri, self,
-                             cols=self.table_details.get(table_name,{}).get('columns'))
-        except TableNotQueryableException as ex:
+            spool = self.get_spool(load_info) if self.concurrent_backfill else None
+            if spool is not None:
+                try:
+                    sflib.write_table(spool.info['table_cols'], spool.info['extraction_columns'], spool.rows(), uri, self)
+                finally:
+                    spool.cleanup()
+            else:
+                sf = sflib.instantiate_from_creds(self.credentials_str)
+                cols = self.table_details.get(table_name,{}).get('columns')
+                try:
+                    state = None
+                    if self.fingerprint:
+                        summary = sflib.get_table_fingerprint(sf, table_name, cols)
+                        if summary is not None:
+                            print(f"Fingerprint of {table_name}: {summary[2:]}", file=sys.stderr)
+                            fingerprint = make_fingerprint(summary, self.compression, self.output_format)
+                            if self.copy_if_unchanged(uri, load_info['instance_ts'], fingerprint,
+                                                      self.dataset_class_prefix+table_name):
+                                return
+                            state = {'fingerprint': fingerprint}
+                    sflib.load_table(sf, table_name, uri, self, cols=cols, state=state)
+                finally:
+                    sf.session.close()
+        except sflib.TableNotQueryableException as ex:
             print(ex, file=sys.stderr)
             non_queryable = True
         except Exception as ex:
             traceback.print_exc()
             failed = True
-        sf.session.close()
         if failed and table_name in self.mandatory_load_tables:
             raise Exception(f"The following mandatory table failed to load: {table_name}")
         